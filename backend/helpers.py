@@ -9,13 +9,39 @@ from transformers import AutoModel, AutoTokenizer
 import vec2text
 from openai import OpenAI
 import json
+import os
 import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from utils.embedding_cache import EmbeddingCache
+from utils.inversion_cache import InversionCache
+from utils.inversion_scheduler import InversionScheduler
+from utils.llm_cache import LLMResponseCache
+from utils.llm_pool import LLMPool
 
 # model paths + settings
 
 embedding_model_name = "sentence-transformers/gtr-t5-base"
 corrector_model_name = "gtr-base"
 OPENAI_MODEL = "gpt-4o-mini"
+# llm backend: "openai", "llamacpp" (local Mistral model) or "fake" (deterministic, offline)
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "openai")
+MISTRAL_MODEL_PATH = os.environ.get(
+    "MISTRAL_MODEL_PATH", "../models/mistral-7b-instruct-v0.2.Q4_K_M.gguf")
+FAKE_LLM_LATENCY = float(os.environ.get(
+    "FAKE_LLM_LATENCY", "0.0"))  # seconds per fake llm call
+# llm response cache: "readwrite", "replay" (recorded responses only) or "off"
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "readwrite")
+llm_cache_size = 10000  # max llm responses kept in memory
+llm_cache_max_disk_mb = 256  # max size of the on-disk llm response cache
+cache_folder = "../cache/"
+embedding_cache_size = 50000  # max embeddings kept in memory
+inversion_max_batch_size = 16  # max embeddings per vec2text batch
+inversion_max_wait = 0.02  # seconds to wait for other requests to join a batch
+inversion_cache_size = 10000  # max inversions kept in memory
+inversion_cache_persist = True  # also store inversions on disk
+llm_max_concurrency = 8  # max llm calls in flight at once
 
 
 # load the api keys from the secrets file
@@ -46,6 +72,57 @@ def mean_pool(
     assert pooled_outputs.shape == (B, D)
     return pooled_outputs
 
+# embed sentences in batches, bucketed by token length and padded per batch
+# inputs: embedding_model (T5EncoderModel), tokenizer (AutoTokenizer), sentences (list),
+#         device (torch.device), max_batch_size (int), max_batch_tokens (int), max_length (int)
+# outputs: embeddings (torch.Tensor), one row per sentence in input order
+
+
+def embed_sentences(embedding_model, tokenizer, sentences, device,
+                    max_batch_size=32, max_batch_tokens=8192, max_length=128):
+    if len(sentences) == 0:
+        return torch.empty((0, embedding_model.config.d_model))
+
+    # token lengths without padding, used to sort sentences into buckets
+    lengths = [len(ids) for ids in tokenizer(
+        sentences, max_length=max_length, truncation=True)["input_ids"]]
+    order = sorted(range(len(sentences)), key=lambda i: lengths[i])
+
+    # greedily fill buckets until the batch size or padded token budget is hit
+    # (sentences are sorted, so the last one added is always the longest)
+    batches = [[]]
+    for i in order:
+        batch = batches[-1]
+        if batch and (len(batch) >= max_batch_size or
+                      (len(batch) + 1) * lengths[i] > max_batch_tokens):
+            batches.append([i])
+        else:
+            batch.append(i)
+
+    batch_embeddings = []
+    with torch.no_grad():
+        for batch in batches:
+            tk = tokenizer(
+                [sentences[i] for i in batch],
+                return_tensors="pt",
+                padding=True,
+                max_length=max_length,
+                truncation=True,
+            )
+            attention_mask = tk.attention_mask.to(device)
+            result = embedding_model(
+                input_ids=tk.input_ids.to(device),
+                attention_mask=attention_mask,
+            )
+            batch_embeddings.append(
+                mean_pool(result.last_hidden_state, attention_mask).cpu())
+
+    # restore the input order
+    sorted_embeddings = torch.cat(batch_embeddings)
+    embeddings = torch.empty_like(sorted_embeddings)
+    embeddings[torch.tensor(order)] = sorted_embeddings
+    return embeddings
+
 # format the new sentences and umap points to return as a list of dict objects
 # inputs: new_sentences (list), new_umap_points (np.ndarray)
 # outputs: new_points (list)
@@ -91,6 +168,30 @@ def format_new_points_interpolate(new_sentences, new_umap_points, weights):
         })
     return new_points
 
+# streaming event for a pipeline stage that just started
+# inputs: stage (str), start_time (float)
+# outputs: event (dict)
+
+
+def stage_event(stage, start_time):
+    return {"event": "stage", "stage": stage, "elapsed": time.time() - start_time}
+
+# streaming event for a new point that is ready
+# inputs: point (dict)
+# outputs: event (dict)
+
+
+def point_event(point):
+    return {"event": "point", "point": point}
+
+# collect the points from a stream of events
+# inputs: events (iterable)
+# outputs: new_points (list)
+
+
+def collect_points(events):
+    return [event["point"] for event in events if event["event"] == "point"]
+
  # Convert float32 obj to regular float
  # inputs: obj (np.number)
     # outputs: float(obj)
@@ -133,13 +234,68 @@ def format_llm_multiline_response(response):
 
     return sentence_list
 
+# split a number of sentences into chunks for parallel llm calls
+# inputs: num_sentences (int), chunk_size (int)
+# outputs: counts (list), the number of sentences per chunk
+
+
+def chunk_counts(num_sentences, chunk_size):
+    return [min(chunk_size, num_sentences - start)
+            for start in range(0, max(num_sentences, 0), chunk_size)]
+
+# [OPENAI] send a chat completion request, through the llm response cache if given
+# inputs: llm (OpenAI), system_prompt (str), user_prompt (str), temperature (float),
+#         cache (LLMResponseCache), sampled (bool), chunk (int), see LLMResponseCache.complete
+# outputs: response (str)
+
+
+def chat_completion(llm, system_prompt, user_prompt, temperature, cache=None, sampled=False, chunk=0):
+    def request():
+        completion = llm.chat.completions.create(
+            model=OPENAI_MODEL,
+            temperature=temperature,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+        )
+        return completion.choices[0].message.content
+
+    if cache is None:
+        return request()
+    return cache.complete(request, OPENAI_MODEL, temperature, system_prompt, user_prompt,
+                          sampled=sampled, chunk=chunk)
+
+# [MISTRAL] run a completion with the local model, through the llm response cache if given
+# inputs: llm (Llama), formatted_prompt (str), max_tokens (int), temperature (float),
+#         echo (bool), stop (list), cache (LLMResponseCache), sampled (bool), chunk (int)
+# outputs: response (str)
+
+
+def mistral_completion(llm, formatted_prompt, max_tokens, temperature, echo, stop, cache=None,
+                       sampled=False, chunk=0):
+    def request():
+        model_output = llm(
+            formatted_prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            echo=echo,
+            stop=stop,
+        )
+        return model_output["choices"][0]["text"]
+
+    if cache is None:
+        return request()
+    return cache.complete(request, MISTRAL_MODEL_PATH, temperature, "", formatted_prompt,
+                          sampled=sampled, chunk=chunk, max_tokens=max_tokens, echo=echo, stop=stop)
+
 # [OPENAI] generate variations of the input sentence using the llm model
 # inputs: llm (OpenAI), num_sentences (int), input_sentence (str),
-#         temperature (float)
+#         temperature (float), cache (LLMResponseCache), chunk (int), index of this call within a request
 # outputs: sentence_list (list)
 
 
-def generate_sentence_variations(llm, num_sentences, input_sentence, temperature=0.5):
+def generate_sentence_variations(llm, num_sentences, input_sentence, temperature=0.5, cache=None, chunk=0):
     variation_prompt = f"""You are an expert prompt writer. You are in charge of writing diverse prompts to send to a large language model.
                         Generate exactly {num_sentences} different variations of Sentence A.
                         A placeholder is a word in square brackets (e.g., [name]). 
@@ -152,15 +308,8 @@ def generate_sentence_variations(llm, num_sentences, input_sentence, temperature
 
     user_prompt = f"Sentence A: {input_sentence}"
 
-    completion = llm.chat.completions.create(
-        model=OPENAI_MODEL,
-        temperature=temperature,
-        messages=[
-            {"role": "system", "content": variation_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    response = completion.choices[0].message.content
+    response = chat_completion(
+        llm, variation_prompt, user_prompt, temperature, cache, sampled=True, chunk=chunk)
 
     # format the response
     sentence_list = format_llm_multiline_response(response)
@@ -170,7 +319,8 @@ def generate_sentence_variations(llm, num_sentences, input_sentence, temperature
 
 # [MISTRAL] generate variations of the input sentence using the llm model
 # inputs: llm (Llama), num_sentences (int), input_sentence (str)
-#         max_tokens (int), temperature (float), echo (bool), stop (list)
+#         max_tokens (int), temperature (float), echo (bool), stop (list), cache (LLMResponseCache),
+#         chunk (int), index of this call within a request
 # outputs: sentence_list (list)
 
 
@@ -178,7 +328,9 @@ def generate_sentence_variations_mistral(llm, num_sentences, input_sentence,
                                          max_tokens=200,
                                          temperature=0.1,
                                          echo=False,
-                                         stop=["Q"]):
+                                         stop=["Q"],
+                                         cache=None,
+                                         chunk=0):
 
     if num_sentences < 1:
         return []
@@ -191,28 +343,20 @@ def generate_sentence_variations_mistral(llm, num_sentences, input_sentence,
         "Pen a short narrative involving flying cupcakes.\n" + \
         f"Just generate the {num_sentences} new prompts without explanations:[/INST]Model answer:</s>"
     # Define the parameters
-    model_output = llm(
-        formatted_prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        echo=echo,
-        stop=stop,
-    )
-
-    sentence_list = model_output["choices"][0]["text"].strip().strip(
-        '"\'').split("\n")
-    sentence_list = [line.split(". ", 1)[1] if line[0].isdigit(
-    ) else line for line in sentence_list]
+    model_output = mistral_completion(
+        llm, formatted_prompt, max_tokens, temperature, echo, stop, cache, sampled=True, chunk=chunk)
 
-    return sentence_list
+    return format_llm_multiline_response(model_output.strip().strip('"\''))
 
 # [OPENAI] general method for prompting the llm model for sentence variations
 # inputs: llm (OpenAI), num_sentences (int), input_sentence (str),
-#         instruction (str), temperature (float)
+#         instruction (str), temperature (float), cache (LLMResponseCache),
+#         chunk (int), index of this call within a request
 # outputs: sentence_list (list)
 
 
-def prompt_for_sentence_variations_llm(llm, num_sentences, input_sentence, instruction, temperature=0.5):
+def prompt_for_sentence_variations_llm(llm, num_sentences, input_sentence, instruction, temperature=0.5, cache=None,
+                                       chunk=0):
     system_prompt = f"""You are an expert prompt writer. You are in charge of writing diverse prompts to send to a large language model.
                 Generate exactly {num_sentences} different variations of Sentence A by appling this instruction: {instruction}.
                 Remember you are not responding to Sentence A, but generating variations of it.
@@ -222,15 +366,8 @@ def prompt_for_sentence_variations_llm(llm, num_sentences, input_sentence, instr
                 """
     user_prompt = f"Sentence A: {input_sentence}"
 
-    completion = llm.chat.completions.create(
-        model=OPENAI_MODEL,
-        temperature=temperature,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    response = completion.choices[0].message.content
+    response = chat_completion(
+        llm, system_prompt, user_prompt, temperature, cache, sampled=True, chunk=chunk)
 
     # format the response
     sentence_list = format_llm_multiline_response(response)
@@ -239,11 +376,11 @@ def prompt_for_sentence_variations_llm(llm, num_sentences, input_sentence, instr
 
 # [OPENAI] correct the input sentence using the llm model
 # inputs: llm (OpenAI), example_sentence (str), input_sentence (str),
-#         temperature (float)
+#         temperature (float), cache (LLMResponseCache)
 # outputs: response_formatted (str)
 
 
-def correct_sentence(llm, example_sentence, input_sentence, temperature=0.1):
+def correct_sentence(llm, example_sentence, input_sentence, temperature=0.1, cache=None):
     correct_prompt = """You are an expert prompt writer. You are in charge of writing diverse prompts to send to a large language model.
                     Follow these steps to modify Sentence A. A placeholder is a word in square brackets (e.g., [name]). 
                     1) If Sentence A contains any placeholders, remove them.
@@ -254,15 +391,8 @@ def correct_sentence(llm, example_sentence, input_sentence, temperature=0.1):
                     Just generate the modified version of Sentence A without explanations:"""
     user_prompt = f"Sentence A: {input_sentence}\nSentence B: {example_sentence}"
 
-    completion = llm.chat.completions.create(
-        model=OPENAI_MODEL,
-        temperature=temperature,
-        messages=[
-            {"role": "system", "content": correct_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    response = completion.choices[0].message.content
+    response = chat_completion(
+        llm, correct_prompt, user_prompt, temperature, cache)
 
     # format the response
     response_formatted = response.strip().strip('"\'')
@@ -271,7 +401,7 @@ def correct_sentence(llm, example_sentence, input_sentence, temperature=0.1):
 
 # [MISTRAL] correct the input sentence using the llm model
 # inputs: llm (Llama), example_sentence (str), input_sentence (str)
-#         max_tokens (int), temperature (float), echo (bool), stop (list)
+#         max_tokens (int), temperature (float), echo (bool), stop (list), cache (LLMResponseCache)
 # outputs: model_output (str)
 
 
@@ -279,7 +409,8 @@ def correct_sentence_mistral(llm, example_sentence, input_sentence,
                              max_tokens=100,
                              temperature=0.1,
                              echo=False,
-                             stop=["Q"]):
+                             stop=["Q"],
+                             cache=None):
 
     formatted_prompt = "[INST]You are an expert prompt writer. Imagine you are writing prompts to send to a large language model." + \
         f"Follow these steps to modify Prompt A = '{input_sentence}'" + \
@@ -287,15 +418,10 @@ def correct_sentence_mistral(llm, example_sentence, input_sentence,
         f"2) Using Prompt B = '{example_sentence}' as an example, edit Prompt A to be a complete and grammatically correct sentence, while maintaining its length." + \
         "Just generate the modified version of Prompt A without explanations:[/INST]Model answer:</s>"
     # Define the parameters
-    model_output = llm(
-        formatted_prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        echo=echo,
-        stop=stop,
-    )
+    model_output = mistral_completion(
+        llm, formatted_prompt, max_tokens, temperature, echo, stop, cache)
 
-    formatted_output = model_output["choices"][0]["text"]
+    formatted_output = model_output
 
     # remove anything before "Prompt A:"
     if ("Prompt A:" in formatted_output):
@@ -306,11 +432,11 @@ def correct_sentence_mistral(llm, example_sentence, input_sentence,
     return formatted_output
 
 # [OPENAI] correct (multiple) interpolation sentences using the llm model
-# inputs: llm (OpenAI), sentences (list), sent1 (str), sent2 (str), temperature (float)
+# inputs: llm (OpenAI), sentences (list), sent1 (str), sent2 (str), temperature (float), cache (LLMResponseCache)
 # outputs: sentence_list (list)
 
 
-def correct_multiple_sentences(llm, sentences, sent1, sent2, temperature=0.1):
+def correct_multiple_sentences(llm, sentences, sent1, sent2, temperature=0.1, cache=None):
     num_sentences = len(sentences)
     system_prompt = f"""You are an expert prompt writer. You are in charge of writing diverse prompts to send to a large language model.
                     Follow these steps to modify each of the {num_sentences} sentences in the list.
@@ -325,15 +451,8 @@ def correct_multiple_sentences(llm, sentences, sent1, sent2, temperature=0.1):
                     Just generate the {num_sentences} new sentences without explanations:"""
     user_prompt = "Sentences:\n" + str(sentences)
 
-    completion = llm.chat.completions.create(
-        model=OPENAI_MODEL,
-        temperature=temperature,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    response = completion.choices[0].message.content
+    response = chat_completion(
+        llm, system_prompt, user_prompt, temperature, cache)
 
     # format the response
     sentence_list = format_llm_multiline_response(response)
@@ -342,9 +461,9 @@ def correct_multiple_sentences(llm, sentences, sent1, sent2, temperature=0.1):
 
 
 # [OPENAI] generate prompt ideas to augment a dataset of sentences
-# inputs: llm (OpenAI), num_prompts (int), sentence (str), temperature (float)
+# inputs: llm (OpenAI), num_prompts (int), sentence (str), temperature (float), cache (LLMResponseCache)
 # outputs: prompt_list (list)
-def generate_prompt_ideas(llm, num_prompts, sentence, temperature=0.5):
+def generate_prompt_ideas(llm, num_prompts, sentence, temperature=0.5, cache=None):
     system_prompt = f"""You are an expert prompt writer in charge of augmenting a dataset of sentences to increase the data diversity.
                     Please come up with {num_prompts} prompt ideas you could send to a large language model to generate diverse variations of the provided sentence. 
                     Remember you're not rewriting the sentence but coming up with ideas that would be useful to modify the sentence in various ways. 
@@ -353,21 +472,266 @@ def generate_prompt_ideas(llm, num_prompts, sentence, temperature=0.5):
                     Just generate the {num_prompts} prompts without explanations:"""
     user_prompt = f"Sentence: {sentence}"
 
-    completion = llm.chat.completions.create(
-        model=OPENAI_MODEL,
-        temperature=temperature,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    response = completion.choices[0].message.content
+    response = chat_completion(
+        llm, system_prompt, user_prompt, temperature, cache)
 
     # format the response
     prompt_list = format_llm_multiline_response(response)
 
     return prompt_list
 
+# [MISTRAL] general method for prompting the llm model for sentence variations
+# inputs: llm (Llama), num_sentences (int), input_sentence (str), instruction (str)
+#         max_tokens (int), temperature (float), echo (bool), stop (list), cache (LLMResponseCache),
+#         chunk (int), index of this call within a request
+# outputs: sentence_list (list)
+
+
+def prompt_for_sentence_variations_mistral(llm, num_sentences, input_sentence, instruction,
+                                           max_tokens=400,
+                                           temperature=0.5,
+                                           echo=False,
+                                           stop=["Q"],
+                                           cache=None,
+                                           chunk=0):
+
+    if num_sentences < 1:
+        return []
+
+    formatted_prompt = f"[INST]Generate exactly {num_sentences} different variations of Sentence A: '{input_sentence}' " + \
+        f"by applying this instruction: {instruction}. " + \
+        "Each new sentence should be different from the original and other generated sentences. " + \
+        "Format your response with one new sentence per line. " + \
+        f"Just generate the {num_sentences} new sentences without explanations:[/INST]Model answer:</s>"
+    model_output = mistral_completion(
+        llm, formatted_prompt, max_tokens, temperature, echo, stop, cache, sampled=True, chunk=chunk)
+
+    return format_llm_multiline_response(model_output)
+
+# [MISTRAL] correct (multiple) interpolation sentences using the llm model
+# inputs: llm (Llama), sentences (list), sent1 (str), sent2 (str)
+#         max_tokens (int), temperature (float), echo (bool), stop (list), cache (LLMResponseCache)
+# outputs: sentence_list (list)
+
+
+def correct_multiple_sentences_mistral(llm, sentences, sent1, sent2,
+                                       max_tokens=400,
+                                       temperature=0.1,
+                                       echo=False,
+                                       stop=["Q"],
+                                       cache=None):
+    num_sentences = len(sentences)
+    formatted_prompt = f"[INST]These {num_sentences} sentences were generated by interpolating between sentence A: '{sent1}' and sentence B: '{sent2}'. " + \
+        "Edit each sentence to be complete and grammatically correct, while maintaining its length and meaning. " + \
+        "Earlier sentences should lean towards sentence A and later sentences towards sentence B. " + \
+        "Format your response with one sentence per line. " + \
+        f"Sentences: {sentences} " + \
+        f"Just generate the {num_sentences} edited sentences without explanations:[/INST]Model answer:</s>"
+    model_output = mistral_completion(
+        llm, formatted_prompt, max_tokens, temperature, echo, stop, cache)
+
+    return format_llm_multiline_response(model_output)
+
+# [MISTRAL] generate prompt ideas to augment a dataset of sentences
+# inputs: llm (Llama), num_prompts (int), sentence (str)
+#         max_tokens (int), temperature (float), echo (bool), stop (list), cache (LLMResponseCache)
+# outputs: prompt_list (list)
+
+
+def generate_prompt_ideas_mistral(llm, num_prompts, sentence,
+                                  max_tokens=300,
+                                  temperature=0.5,
+                                  echo=False,
+                                  stop=["Q"],
+                                  cache=None):
+    formatted_prompt = f"[INST]Come up with {num_prompts} concise and unique prompt ideas you could send to a large language model " + \
+        f"to generate diverse variations of this sentence: '{sentence}'. " + \
+        "Don't include the sentence in the prompts. Format your response with one prompt per line, without numbers or bullet points. " + \
+        f"Just generate the {num_prompts} prompts without explanations:[/INST]Model answer:</s>"
+    model_output = mistral_completion(
+        llm, formatted_prompt, max_tokens, temperature, echo, stop, cache)
+
+    return format_llm_multiline_response(model_output)
+
+
+# LLM PROVIDERS
+# every provider implements the same llm calls used by the SAE pipeline
+
+
+class LLMProvider(ABC):
+    name = 'base'
+    cache = None
+
+    # correct the input sentence, using the example sentence as reference
+    # inputs: example_sentence (str), input_sentence (str)
+    # outputs: sentence (str)
+    @abstractmethod
+    def correct(self, example_sentence, input_sentence):
+        ...
+
+    # generate variations of the input sentence; requests split into parallel
+    # calls pass each call's chunk index, so recorded responses do not collide
+    # inputs: num_sentences (int), input_sentence (str), chunk (int)
+    # outputs: sentence_list (list)
+    @abstractmethod
+    def vary(self, num_sentences, input_sentence, chunk=0):
+        ...
+
+    # generate variations of the input sentence by applying an instruction
+    # inputs: num_sentences (int), input_sentence (str), instruction (str), chunk (int)
+    # outputs: sentence_list (list)
+    @abstractmethod
+    def instruct_vary(self, num_sentences, input_sentence, instruction, chunk=0):
+        ...
+
+    # correct interpolated sentences between sent1 and sent2
+    # inputs: sentences (list), sent1 (str), sent2 (str)
+    # outputs: sentence_list (list)
+    @abstractmethod
+    def correct_multiple(self, sentences, sent1, sent2):
+        ...
+
+    # generate prompt ideas to augment the sentence
+    # inputs: num_prompts (int), sentence (str)
+    # outputs: prompt_list (list)
+    @abstractmethod
+    def prompt_ideas(self, num_prompts, sentence):
+        ...
+
+
+class OpenAIProvider(LLMProvider):
+    name = 'openai'
+
+    def __init__(self, api_key, cache=None):
+        self.cache = cache
+        # replaying recorded responses does not need the API
+        self.client = None if cache is not None and cache.replay else OpenAI(
+            api_key=api_key)
+
+    def correct(self, example_sentence, input_sentence):
+        return correct_sentence(self.client, example_sentence, input_sentence, cache=self.cache)
+
+    def vary(self, num_sentences, input_sentence, chunk=0):
+        return generate_sentence_variations(self.client, num_sentences, input_sentence, cache=self.cache,
+                                            chunk=chunk)
+
+    def instruct_vary(self, num_sentences, input_sentence, instruction, chunk=0):
+        return prompt_for_sentence_variations_llm(self.client, num_sentences, input_sentence, instruction,
+                                                  cache=self.cache, chunk=chunk)
+
+    def correct_multiple(self, sentences, sent1, sent2):
+        return correct_multiple_sentences(self.client, sentences, sent1, sent2, cache=self.cache)
+
+    def prompt_ideas(self, num_prompts, sentence):
+        return generate_prompt_ideas(self.client, num_prompts, sentence, cache=self.cache)
+
+
+class LlamaCppProvider(LLMProvider):
+    name = 'llamacpp'
+
+    def __init__(self, model_path, cache=None):
+        from llama_cpp import Llama  # optional dependency, only needed for local models
+        self.cache = cache
+        self.client = Llama(model_path=model_path, n_ctx=2048, verbose=False)
+        # llama.cpp models are not thread-safe
+        self._lock = threading.Lock()
+
+    def correct(self, example_sentence, input_sentence):
+        with self._lock:
+            return correct_sentence_mistral(self.client, example_sentence, input_sentence, cache=self.cache)
+
+    def vary(self, num_sentences, input_sentence, chunk=0):
+        with self._lock:
+            return generate_sentence_variations_mistral(self.client, num_sentences, input_sentence,
+                                                        cache=self.cache, chunk=chunk)
+
+    def instruct_vary(self, num_sentences, input_sentence, instruction, chunk=0):
+        with self._lock:
+            return prompt_for_sentence_variations_mistral(self.client, num_sentences, input_sentence, instruction,
+                                                          cache=self.cache, chunk=chunk)
+
+    def correct_multiple(self, sentences, sent1, sent2):
+        with self._lock:
+            return correct_multiple_sentences_mistral(self.client, sentences, sent1, sent2, cache=self.cache)
+
+    def prompt_ideas(self, num_prompts, sentence):
+        with self._lock:
+            return generate_prompt_ideas_mistral(self.client, num_prompts, sentence, cache=self.cache)
+
+
+class FakeLLMProvider(LLMProvider):
+    """Deterministic stand-in for offline benchmarks and load tests.
+
+    Every call sleeps for `latency` seconds and returns text derived only
+    from its inputs.
+    """
+    name = 'fake'
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _as_sentence(text):
+        # inversions are passed in as a list of sentences
+        if isinstance(text, list):
+            text = text[0] if text else ''
+        text = str(text).strip().strip('"\'')
+        return text if text.endswith(('.', '?', '!', '"')) else text + '.'
+
+    @staticmethod
+    def _rotate(sentence, i):
+        words = sentence.rstrip('.?!').split()
+        if not words:
+            return sentence
+        shift = i % len(words)
+        return ' '.join(words[shift:] + words[:shift]) + sentence[len(sentence.rstrip('.?!')):]
+
+    def correct(self, example_sentence, input_sentence):
+        self._wait()
+        return self._as_sentence(input_sentence)
+
+    def vary(self, num_sentences, input_sentence, chunk=0):
+        self._wait()
+        sentence = self._as_sentence(input_sentence)
+        start = chunk * num_sentences + 1
+        return [self._rotate(sentence, start + i) for i in range(num_sentences)]
+
+    def instruct_vary(self, num_sentences, input_sentence, instruction, chunk=0):
+        self._wait()
+        sentence = self._as_sentence(input_sentence)
+        start = chunk * num_sentences + 1
+        return [f'{self._rotate(sentence, start + i)} ({instruction})' for i in range(num_sentences)]
+
+    def correct_multiple(self, sentences, sent1, sent2):
+        self._wait()
+        return [self._as_sentence(sentence) for sentence in sentences]
+
+    def prompt_ideas(self, num_prompts, sentence):
+        self._wait()
+        return [f'Rewrite the sentence with variation {i + 1}.' for i in range(num_prompts)]
+
+
+# load the configured llm provider
+# inputs: provider_name (str), cache (LLMResponseCache)
+# outputs: llm (LLMProvider)
+def load_llm_provider(provider_name=LLM_PROVIDER, cache=None):
+    if provider_name == 'openai':
+        return OpenAIProvider(None if cache is not None and cache.replay else load_api_keys(), cache)
+    elif provider_name == 'llamacpp':
+        return LlamaCppProvider(MISTRAL_MODEL_PATH, cache)
+    elif provider_name == 'fake':
+        return FakeLLMProvider(latency=FAKE_LLM_LATENCY)
+    else:
+        raise ValueError(f"invalid LLM provider: {provider_name}")
+
 # load dataset-agnostic models needed to run backend
 # outputs: model_dict (dict)
 
@@ -393,10 +757,23 @@ def load_models():
     corrector = vec2text.load_pretrained_corrector(
         corrector_model_name)
     print('corrector model loaded:', corrector_model_name)
-
-    # Load OpenAI API
-    api_key = load_api_keys()
-    llm = OpenAI(api_key=api_key)
+    inverter = InversionScheduler(
+        corrector, max_batch_size=inversion_max_batch_size, max_wait=inversion_max_wait)
+    inversion_cache = InversionCache(
+        corrector_model_name, max_items=inversion_cache_size,
+        path=cache_folder + 'inversions.sqlite' if inversion_cache_persist else None)
+    embedding_cache = EmbeddingCache(
+        embedding_model_name, max_items=embedding_cache_size,
+        path=cache_folder + 'embeddings.sqlite')
+    print('embedding cache loaded:', embedding_cache.store.path)
+
+    # Load the llm provider
+    llm_cache = LLMResponseCache(
+        LLM_CACHE_MODE, max_items=llm_cache_size, path=cache_folder + 'llm_responses.sqlite',
+        max_disk_bytes=llm_cache_max_disk_mb * 1024 * 1024)
+    llm = load_llm_provider(cache=llm_cache)
+    print('llm provider loaded:', llm.name, f'(cache: {llm_cache.mode})')
+    llm_pool = LLMPool(max_concurrency=llm_max_concurrency)
 
     # return a dictionary with all the models
     model_dict = {
@@ -404,7 +781,12 @@ def load_models():
         'device': device,
         'embedding_model': embedding_model,
         'tokenizer': tokenizer,
+        'embedding_cache': embedding_cache,
         'corrector': corrector,
-        'llm': llm
+        'inverter': inverter,
+        'inversion_cache': inversion_cache,
+        'llm': llm,
+        'llm_cache': llm_cache,
+        'llm_pool': llm_pool
     }
     return model_dict
@@ -4,24 +4,62 @@ Copyright (C) 2024 Apple Inc. All Rights Reserved.
 """
 
 import time
-import pandas as pd
+import threading
 import torch
 from transformers.utils import logging
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
-import vec2text
 import pickle
-from utils.sparse_autoencoder import SparseAutoencoder, load_sae_file
-from helpers import correct_multiple_sentences, correct_sentence, format_new_points_interpolate, format_new_points_umap, generate_prompt_ideas, generate_sentence_variations, mean_pool, format_new_points, prompt_for_sentence_variations_llm
+from utils.activation_matrix import ActivationMatrix, build_csr
+from utils.artifacts import get_shared_artifacts
+from utils.embedding_store import EmbeddingStore
+from utils.feature_neighbors import neighbor_count
+from utils.neighbor_index import NeighborIndex
+from utils.sae_inference import InferenceSAE
+from utils.sentence_store import SentenceStore
+from helpers import chunk_counts, collect_points, format_new_points_interpolate, format_new_points_umap, embed_sentences, format_new_points, point_event, stage_event
 import os
 import umap
+from concurrent.futures import ThreadPoolExecutor
 
 logging.set_verbosity_error()  # Suppress warnings
 
 # SETTINGS
 model_folder = "../models/"
 data_folder = "../data/"
-activation_threshold = 0.01
+activation_threshold = 0.01  # activations at or below this are not stored
+activation_chunk_size = 256  # rows per sae.encode batch when encoding the dataset
+activation_save_delay = 5  # seconds to gather changes before the activation matrix is saved
+# reduced-precision SAE inference on cpu-only servers: 'bf16', 'int8' (see utils/sae_inference.py)
+# or None for the float32 model; activations are cached separately per precision
+sae_cpu_precision = None
+default_top_activations_limit = 100  # max active features kept by get_top_activations, None for all
+embed_batch_size = 32  # max sentences per encoder batch
+embed_max_batch_tokens = 8192  # max padded tokens per encoder batch
+llm_chunk_size = 5  # max sentences requested per parallel llm call
+umap_settings = {'n_neighbors': 100, 'min_dist': 0.1, 'n_components': 2, 'metric': 'cosine'}
+umap_warm_start_epochs = 100  # layout optimization epochs when refitting from the current layout
+embedding_wal_compact_mb = 64  # compact the embeddings WAL into a new snapshot past this size
+added_sentence_cluster = 'New'  # cluster of added sentences in /data, the frontend's new_category
+
+# inversion modes: vec2text correction steps and beam width, from fastest to best
+inversion_modes = {
+    'preview': {'num_steps': None, 'sequence_beam_width': 0},  # hypothesis model only
+    'balanced': {'num_steps': 5, 'sequence_beam_width': 0},
+    'full': {'num_steps': 20, 'sequence_beam_width': 4},
+}
+# 'adaptive' runs the modes in this order and stops once the re-embedded
+# hypothesis reaches the target cosine similarity to the goal embedding
+adaptive_inversion_schedule = ['preview', 'balanced', 'full']
+adaptive_target_cosine = 0.95
+inversion_mode_names = list(inversion_modes) + ['adaptive']
+default_inversion_mode = 'preview'  # same settings as vec2text's defaults
+
+# projection of new points into the 2d layout: 'umap' runs the reducer's transform,
+# 'knn' places each point at the similarity-weighted mean of its nearest placed neighbors
+projection_mode_names = ['umap', 'knn']
+default_projection_mode = 'umap'
+knn_projection_k = 15
+knn_projection_refine = True  # replace knn placements with the umap transform in the background
 
 # SAE CLASS
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -32,111 +70,195 @@ wiki_sae_datasets = ['wiki', 'writing', 'chi', 'hcslab', 'cps', 'chi2025']
 class SAE(object):
     def __init__(self, model_dict, dataset="wiki"):
         print(f'initializing {dataset} SAE...')
+        self.dataset = dataset
         self.device = model_dict['device']
 
         # get dataset name without numbers
         dataset_no_num = ''.join(
             [i for i in dataset if not i.isdigit()]) if dataset not in wiki_sae_datasets else 'wiki'
 
-        # Load the sae model
-        sae_path = model_folder + f'{dataset_no_num}_model.safetensors'
-        self.sae = SparseAutoencoder.from_safetensors_file(
-            sae_path) if dataset_no_num == 'wiki' else load_sae_file(sae_path)
-        self.sae.to(self.device)  # move the model to the device
-        print('\nsae model loaded')
+        # Shared, read-only artifacts (sae model + features), loaded once per process
+        self.sae_precision = sae_cpu_precision if self.device.type == 'cpu' else None
+        self.artifacts = get_shared_artifacts(
+            dataset_no_num, model_folder, self.device, self.sae_precision)
+        self.sae = self.artifacts.sae
+        self.features = self.artifacts.features
+        self.feature_neighbors = self.artifacts.feature_neighbors
+        self.feature_store = self.artifacts.feature_store
 
         # Load the embedding model and tokenizer
         self.embedding_model = model_dict['embedding_model']
         self.tokenizer = model_dict['tokenizer']
+        self.embedding_cache = model_dict['embedding_cache']
         self.corrector = model_dict['corrector']
+        self.inverter = model_dict['inverter']  # batches inversions across requests
+        self.inversion_cache = model_dict['inversion_cache']
 
-        # Load the features
-        features_file = model_folder + \
-            f'{dataset_no_num}_features.npy'
-        self.features = np.load(features_file)
-        self.feature_sim_matrix = cosine_similarity(
-            self.features)  # Precompute the similarity matrix
-        features_info_file = model_folder + \
-            f'{dataset_no_num}_feature_info.csv'
-        self.feature_info = pd.read_csv(features_info_file)
-        print('\nfeatures loaded')
-        print('features shape:', self.features.shape)
-        print('feature_info shape:', self.feature_info.shape)
-
+        # Per-dataset state: umap reducer, embeddings, neighbor index, prompts
         # Load the umap model
         umap_file = model_folder + f'{dataset}_umap_reducer'
         umap_pickle = open(umap_file, 'rb')
         self.umap_reducer = pickle.load(umap_pickle)
+        self.umap_nbytes = os.path.getsize(umap_file)  # rough in-memory size
         print('\numap reducer loaded')
 
+        # Durable embeddings: mmap'd snapshot + write-ahead log of edits,
+        # created from the original .pt file on first use
         emb_file = data_folder + f"{dataset}/{dataset}_embeddings.pt"
-        self.embeddings = torch.load(
-            emb_file, map_location=self.device, weights_only=True)
-        self.embed_sim_matrix = cosine_similarity(
-            self.embeddings.cpu())  # Precompute the similarity matrix
+        self.embedding_store = EmbeddingStore(
+            data_folder + dataset, dataset, compact_bytes=embedding_wal_compact_mb * 1024 * 1024)
+        embeddings = self.embedding_store.load(lambda: torch.load(
+            emb_file, map_location='cpu', weights_only=True).numpy())
+        # Durable sentence text and 2d positions by the same stable ids, served by /data
+        self.sentence_store = SentenceStore(
+            data_folder + f"{dataset}/{dataset}_data.json",
+            data_folder + f"{dataset}/{dataset}_sentences.jsonl").load(truncate=True)
+        self.reconcile_sentences()
+        self.embeddings = torch.from_numpy(embeddings).to(self.device)
+        # Index the normalized embeddings for nearest-neighbor search
+        self.neighbor_index = NeighborIndex(self.embeddings.cpu().numpy())
+        self.neighbor_index.remove(np.flatnonzero(~self.embedding_store.alive))
+        # Current 2d position of every storage row (NaN until projected), used to
+        # warm-start UMAP refits; the reducer's own fit covers the original rows,
+        # the sentence store has the positions recorded since
+        self.layout = np.full((len(self.embeddings), 2), np.nan, dtype=np.float32)
+        fitted = getattr(self.umap_reducer, 'embedding_', None)
+        if fitted is not None and len(fitted) == len(self.layout):
+            self.layout[:] = fitted
+        self.load_layout()
+        # per projection mode call counts and time spent, plus background refinements
+        self.projection_metrics = {name: {'calls': 0, 'points': 0, 'seconds': 0.0}
+                                   for name in projection_mode_names}
+        self.projection_metrics['knn']['refined'] = 0
+        self.refine_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'{dataset}-refine')
+
+        # Sparse SAE activations of every row, saved for the current embeddings
+        # state or rebuilt in the background (lookups fall back to the encoder meanwhile)
+        precision_suffix = f'_{self.sae_precision}' if self.sae_precision else ''
+        self.activations_file = data_folder + f"{dataset}/{dataset}{precision_suffix}_activations.npz"
+        self.activation_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'{dataset}-activations')
+        self.activations_save_pending = False
+        self._closed = threading.Event()
+        self.activations = ActivationMatrix.load(
+            self.activations_file, len(self.features), activation_threshold,
+            self.embedding_store.fingerprint(), self.embedding_store.ids)
+        if self.activations is None:
+            self.activations = ActivationMatrix(len(self.features), activation_threshold)
+            self.activation_executor.submit(self.build_activations)
+        else:
+            print('activations loaded:', self.activations_file)
         print('embeddings loaded:', emb_file)
         print('embeddings shape:', self.embeddings.shape)
 
-        self.llm = model_dict['llm']
+        self.llm = model_dict['llm']  # LLMProvider
+        self.llm_pool = model_dict['llm_pool']
         self.prompt_dict = {}
 
         print('\nDONE! SAE initialized.')
 
+    # estimate the memory used by this dataset (shared artifacts excluded)
+    # outputs: nbytes (int)
+    def memory_footprint(self):
+        embeddings_nbytes = self.embeddings.element_size() * self.embeddings.nelement()
+        return (embeddings_nbytes + self.neighbor_index.nbytes() + self.umap_nbytes
+                + self.activations.nbytes())
+
     # get the top k nearest neighbors to the input sentence id
     # inputs: sentence_id (int), top_k (int)
     # outputs: top_neighbors (list)
     def get_top_neighbors(self, sentence_id, top_k=10):
-        # get row from similarity matrix
-        sim_row = self.embed_sim_matrix[sentence_id]
-        # get the indices of the top k neighbors (excluding the input sentence)
-        top_neighbors = np.argsort(-sim_row)[1:top_k+1]
+        top_neighbors = self.get_top_neighbors_batch([sentence_id], top_k)[0]
         print('top neighbors:', top_neighbors)
         return top_neighbors
 
+    # get the top k nearest neighbors for several sentence ids at once
+    # inputs: sentence_ids (list), top_k (int)
+    # outputs: top_neighbors (np.ndarray), one row per sentence id
+    # raises: IndexError for ids that are out of range or were removed
+    def get_top_neighbors_batch(self, sentence_ids, top_k=10):
+        with self.embedding_store.lock:
+            rows = [self.embedding_store.row(id) for id in sentence_ids]
+            unknown = [id for id, row in zip(sentence_ids, rows) if row is None]
+            if unknown:
+                raise IndexError(f'Unknown sentence ids: {unknown}')
+            neighbors, _ = self.neighbor_index.search_rows(rows, top_k + 1)
+            # exclude the closest match (the input sentence itself)
+            return self.embedding_store.positions(neighbors[:, 1:top_k+1])
+
     # get the top k most similar features to the input feature
     # inputs: feature_id (int), k (int), top_percent (float)
     # outputs: sampled_features (list)
     def get_similar_features(self, feature_id, k=5, top_percent=0.001):
-        sim_row = self.feature_sim_matrix[feature_id]
-        sorted_row = np.argsort(-sim_row)[1:]
+        # neighbors of the feature, sorted by similarity (excluding itself)
+        sorted_row = self.feature_neighbors[feature_id]
         # get top percent% of similar features
-        top_k = int(len(sorted_row) * top_percent)
-        top_features = sorted_row[1:top_k+1]  # exclude the input feature
+        top_k = neighbor_count(len(self.feature_neighbors), top_percent) - 1
+        top_features = sorted_row[1:top_k+1]  # skip the closest neighbor
         sampled_features = np.random.choice(top_features, k, replace=False)
         return sampled_features
 
-    # add the input embedding to the embeddings and update the similarity matrix
-    # inputs: emb (torch.Tensor)
-    def add_embedding(self, emb):
-        # if embeddings is an nxm matrix, emb should be a 1xm matrix
+    # add the input embedding(s) to the embeddings and the neighbor index
+    # inputs: emb (torch.Tensor), either 1xm / m for one embedding or kxm for k embeddings,
+    #         sentences (list or None), the text of each embedding
+    # outputs: rows (np.ndarray), the storage rows of the new embeddings
+    def add_embedding(self, emb, sentences=None):
+        # if embeddings is an nxm matrix, emb should be a kxm matrix
         if emb.dim() == 1:
             emb = emb.unsqueeze(0)
-
-        # Concatenate the new embedding
-        self.embeddings = torch.cat((self.embeddings, emb.to(self.device)))
-
-        # Compute similarities with all embeddings (including the new one)
-        new_sim_matrix = cosine_similarity(self.embeddings.cpu())
-
-        # Update the similarity matrix
-        self.embed_sim_matrix = new_sim_matrix
+        activations = self.encode_activations(emb)
+
+        with self.embedding_store.lock:
+            rows = np.arange(len(self.embeddings), len(self.embeddings) + len(emb))
+            # Concatenate the new embedding(s)
+            self.embeddings = torch.cat((self.embeddings, emb.to(self.device)))
+            self.embedding_store.add(emb.cpu().numpy())
+            if sentences is not None:
+                self.sentence_store.set(self.embedding_store.ids[rows], [
+                    {'sentence': sentence, 'cluster': added_sentence_cluster} for sentence in sentences])
+            self.activations.set_rows(rows, activations)
+            # Add the new embedding(s) to the neighbor index, in the same row order
+            self.neighbor_index.add(emb.cpu().numpy())
+        self.save_activations()
+        self.compact_embeddings()
         print('embedding added, new shape:', self.embeddings.shape)
+        return rows
 
-    # remove the input embedding from the embeddings and update the similarity matrix
+    # remove the input embedding: its row is tombstoned in the store and the
+    # neighbor index, and later sentence ids move up by one
     # inputs: id (int)
     def remove_embedding(self, id):
-        self.embeddings = torch.cat(
-            (self.embeddings[:id], self.embeddings[id+1:]))
-        new_sim_matrix = cosine_similarity(self.embeddings.cpu())
-        self.embed_sim_matrix = new_sim_matrix
-        print('embedding removed, new shape:', self.embeddings.shape)
+        with self.embedding_store.lock:
+            row = self.embedding_store.remove(id)
+            self.sentence_store.remove([self.embedding_store.ids[row]])
+            self.activations.clear_rows(row)
+            self.neighbor_index.remove(row)
+        self.save_activations()
+        self.compact_embeddings()
+        print('embedding removed, sentences left:', self.embedding_store.size)
+
+    # finish pending saves and background work and close the embeddings WAL,
+    # e.g. before the dataset registry evicts this instance (a new instance may
+    # then open the same files); writes after close raise RuntimeError
+    def close(self):
+        self._closed.set()
+        self.refine_executor.shutdown(wait=True, cancel_futures=True)
+        self.activation_executor.shutdown(wait=True)
+        self.embedding_store.close()
+        print(f'{self.dataset} closed')
+
+    # compact the embeddings WAL (and tombstones) into a new snapshot in the background once it is large
+    def compact_embeddings(self):
+        self.embedding_store.maybe_compact(lambda: self.embeddings.cpu().numpy())
 
     # get the existing embedding for the specified id
     # inputs: id (int)
     # outputs: sentence_embedding (torch.Tensor) or None
     def get_existing_embedding(self, id):
-        if id >= 0 and id < len(self.embeddings):
-            sentence_embedding = self.embeddings[id]
+        row = self.embedding_store.row(id)
+        if row is not None:
+            sentence_embedding = self.embeddings[row]
             return sentence_embedding
         return None
 
@@ -144,109 +266,262 @@ class SAE(object):
     # inputs: sentence (string)
     # outputs: embedding (torch.Tensor)
     def get_sentence_embedding(self, sentence):
-        with torch.no_grad():
-            device = self.device
-            tk = self.tokenizer(
-                [sentence],
-                return_tensors="pt",
-                padding=True,
-                max_length=128,
-                truncation=True,
-            )
+        return self.get_sentence_embeddings([sentence])[0]
 
-            result = self.embedding_model(
-                input_ids=tk.input_ids.to(device),
-                attention_mask=tk.attention_mask.to(device),
-            )
-            hidden_state = result.last_hidden_state
-            emb = mean_pool(hidden_state, tk.attention_mask.to(device)).cpu()
-            emb = emb.squeeze(0)
-            return emb
+    # embed multiple sentences in length-bucketed batches, reusing cached embeddings
+    # inputs: sentences (list)
+    # outputs: embeddings (torch.Tensor), one row per sentence
+    def get_sentence_embeddings(self, sentences):
+        embeddings = self.embedding_cache.get_many(sentences)
+        missing = [i for i, emb in enumerate(embeddings) if emb is None]
+        if missing:
+            missing_sentences = [sentences[i] for i in missing]
+            start_time = time.time()
+            new_embeddings = embed_sentences(self.embedding_model, self.tokenizer,
+                                             missing_sentences, self.device,
+                                             max_batch_size=embed_batch_size,
+                                             max_batch_tokens=embed_max_batch_tokens)
+            self.embedding_cache.record_encode(
+                len(missing), time.time() - start_time)
+            self.embedding_cache.put_many(missing_sentences, new_embeddings)
+            for i, emb in zip(missing, new_embeddings):
+                embeddings[i] = emb
+        if not embeddings:
+            return torch.empty((0, self.embeddings.shape[1]))
+        return torch.stack(embeddings)
 
     # add multiple sentence embeddings to the embeddings
     # inputs: sentences (list)
-    # outputs: emb_list (list)
+    # outputs: emb_list (list), rows (np.ndarray)
     def add_sentence_embeddings(self, sentences):
-        # store all embeddings in a tensor
-        emb_list = []
-        for sentence in sentences:
-            emb = self.get_sentence_embedding(sentence)
-            emb_list.append(emb)
-            self.add_embedding(emb)
+        # embed all sentences in batches
+        emb_list = self.get_sentence_embeddings(sentences)
+        # add them to the dataset in one bulk update
+        rows = self.add_embedding(emb_list, sentences)
         print('all embeddings added')
-        # convert to tensor
-        emb_list = torch.stack(emb_list)
-        return emb_list
+        return emb_list, rows
+
+    # encode embeddings with the SAE, in chunks of activation_chunk_size rows
+    # inputs: embeddings (torch.Tensor), kxm
+    # outputs: activations (np.ndarray), kxF
+    def encode_activations(self, embeddings):
+        if len(embeddings) == 0:
+            return np.empty((0, len(self.features)), dtype=np.float32)
+        return np.concatenate(list(self.encode_activation_chunks(embeddings)))
+
+    # same as encode_activations, one chunk at a time
+    # inputs: embeddings (torch.Tensor), kxm
+    # outputs: activations (generator of np.ndarray)
+    def encode_activation_chunks(self, embeddings):
+        with torch.no_grad():
+            for start in range(0, len(embeddings), activation_chunk_size):
+                chunk = embeddings[start:start + activation_chunk_size]
+                yield self.sae.encode(chunk.to(self.device).to(torch.float32)).cpu().numpy()
 
-    # get the top k most similar features to the input embedding
-    # inputs: embedding (torch.Tensor), top_k (int)
-    # outputs: top_activations (list), similar_features (list)
-    def get_top_activations(self, embedding, top_k=10):
+    # encode every row of the dataset into the sparse activation matrix
+    def build_activations(self):
+        start_time = time.time()
+        with self.embedding_store.lock:
+            embeddings = self.embeddings
+            removed = np.flatnonzero(~self.embedding_store.alive)
+        def chunks():
+            for chunk in self.encode_activation_chunks(embeddings):
+                if self._closed.is_set():
+                    return
+                yield chunk
+        csr = build_csr(chunks(), activation_threshold)
+        if self._closed.is_set():
+            return  # closed while building, the next load rebuilds
+        # rows changed while this runs are in the matrix's overlay, which wins over these
+        self.activations.set_base(*csr)
+        self.activations.clear_rows(removed)
+        print(f'{self.dataset} activations built in:', time.time() - start_time)
+        self.save_activations()
+
+    # save the activation matrix in the background, gathering changes for a few seconds first
+    def save_activations(self):
+        if self.activations_save_pending:
+            return
+        self.activations_save_pending = True
+        self.activation_executor.submit(self._save_activations)
+
+    def _save_activations(self):
+        self._closed.wait(activation_save_delay)  # close() saves right away
+        self.activations_save_pending = False
+        if not self.activations.ready:
+            return
+        with self.embedding_store.lock:
+            fingerprint = self.embedding_store.fingerprint()
+            ids = self.embedding_store.ids
+            snapshot = self.activations.snapshot()
+        self.activations.save(self.activations_file, fingerprint, ids, snapshot)
+
+    # get the strongest features of the input embedding and their similar features
+    # inputs: embedding (torch.Tensor), top_k (int), limit (int or None)
+    # outputs: features (np.ndarray), activations (np.ndarray), similar_features (list)
+    def get_top_activations(self, embedding, top_k=10, limit=default_top_activations_limit):
+        if limit is not None:
+            features, activations = self.encode_top_activations(embedding, limit)
+        else:
+            feature_activations = self.encode_activations(embedding.reshape(1, -1))[0]
+            features = np.flatnonzero(feature_activations > activation_threshold)
+            activations = feature_activations[features]
+        return self.format_top_activations(features, activations, top_k, limit)
+
+    # encode one embedding keeping only its `limit` strongest features above the threshold;
+    # the inference SAE selects them inside the encoder (encode_topk)
+    # inputs: embedding (torch.Tensor), limit (int)
+    # outputs: features (np.ndarray), activations (np.ndarray), by descending activation
+    def encode_top_activations(self, embedding, limit):
+        x = embedding.reshape(1, -1).to(self.device).to(torch.float32)
         with torch.no_grad():
-            device = self.device
-            sae_inputs = embedding.to(device).to(torch.float32)
-            feature_activations: np.ndarray = (
-                self.sae.encode(sae_inputs).squeeze(0).cpu().numpy()
+            if isinstance(self.sae, InferenceSAE):
+                values, indices = self.sae.encode_topk(x, limit)
+            else:
+                values, indices = torch.topk(self.sae.encode(x), min(limit, len(self.features)), dim=1)
+        values, indices = values[0].cpu().numpy(), indices[0].cpu().numpy()
+        keep = values > activation_threshold
+        return indices[keep], values[keep]
+
+    # get the strongest of the given active features and the similar features of the top k
+    # inputs: features (np.ndarray), activations (np.ndarray), top_k (int), limit (int or None)
+    # outputs: features (np.ndarray), activations (np.ndarray), similar_features (list)
+    def format_top_activations(self, features, activations, top_k=10, limit=default_top_activations_limit):
+        # keep only the strongest `limit` features, then sort just those
+        if limit is not None and limit < len(activations):
+            keep = np.argpartition(-activations, limit - 1)[:limit]
+            features, activations = features[keep], activations[keep]
+        order = np.argsort(-activations, kind='stable')
+        features, activations = features[order], activations[order]
+        top_features = features[:top_k]
+
+        # Get similar features for each of the top k features
+        similar_features = []
+        for feature in top_features:
+            similar_features.extend(
+                self.get_similar_features(feature, k=5)
             )
 
-            # Get the indices of the top k features
-            all_features = np.argsort(-feature_activations)
-            top_features = all_features[:top_k]
-
-            # Get similar features for each of the top k features
-            similar_features = []
-            for feature in top_features:
-                similar_features.extend(
-                    self.get_similar_features(feature, k=5)
-                )
-
-            # Remove duplicates
-            similar_features = np.unique(similar_features)
-            # Exclude features that are already in top_features
-            similar_features = np.setdiff1d(
-                similar_features, top_features, assume_unique=True)
-
-            # Create dictionary of top activations
-            top_activations = {
-                int(feature): float(feature_activations[feature])
-                for feature in all_features
-            }
-
-            return top_activations, similar_features.tolist()
-
-    # get the top k most similar features to the input sentence
-    # inputs: sentence (string), id (int), top_k (int)
-    # outputs: top_activations (list), similar_features (list)
-    def get_top_activations_from_sentence(self, sentence, id, top_k=10):
-        emb = self.get_existing_embedding(id)
-        if emb is None:
-            emb = self.get_sentence_embedding(sentence)
-        print('finished embedding sentence')
-
-        top_features, similar_features = self.get_top_activations(emb, top_k)
-        # print('top_features:', top_features)
+        # Remove duplicates
+        similar_features = np.unique(similar_features)
+        # Exclude features that are already in top_features
+        similar_features = np.setdiff1d(
+            similar_features, top_features, assume_unique=True)
+
+        return features, activations, similar_features.tolist()
+
+    # get the strongest features of the input sentence with their summaries
+    # every feature with info when limit is None, else the limit strongest plus the similar features
+    # inputs: sentence (string), id (int), top_k (int), limit (int or None)
+    # outputs: top_activations (list of {'feature', 'summary', 'activation'}), similar_features (list)
+    def get_top_activations_from_sentence(self, sentence, id, top_k=10, limit=None):
+        # existing sentences are a row lookup in the activation matrix
+        row = self.embedding_store.row(id)
+        entry = self.activations.row(row) if row is not None else None
+        if entry is not None:
+            features, activations, similar_features = self.format_top_activations(*entry, top_k, limit)
+        else:
+            emb = self.get_existing_embedding(id)
+            if emb is None:
+                emb = self.get_sentence_embedding(sentence)
+            print('finished embedding sentence')
+            features, activations, similar_features = self.get_top_activations(emb, top_k, limit)
         print('got top activations')
-
-        # Get the feature info for the top activations using the feature_info dataframe
-        df_features = self.feature_info
-        # 1) find the corresponding rows for the top features
-        rows = df_features[df_features['feature'].isin(
-            top_features.keys())].copy()
-        # 2) add the activations to the rows
-        rows['activation'] = rows['feature'].apply(
-            lambda x: top_features[x])
-        # 3) sort rows in rows by top_activations
-        rows = rows.sort_values('activation', ascending=False)
-        # 4) only save the feature, summary, activation columns
-        rows = rows[['feature', 'summary', 'activation']]
-
-        return rows, similar_features
+        # inactive features (at or below the threshold) go last with activation 0: all of them
+        # without a limit, otherwise the similar features so the frontend can list them
+        features, activations = self.with_inactive_features(
+            features, activations, self.feature_store.ids if limit is None else similar_features)
+
+        # join the summaries by feature id, skipping features without info
+        summaries = self.feature_store.summaries(features)
+        top_activations = [
+            {'feature': int(feature), 'summary': summary, 'activation': float(activation)}
+            for feature, summary, activation in zip(features, summaries, activations)
+            if summary is not None
+        ]
+        return top_activations, similar_features
+
+    # append the candidate features that are not in features, with activation 0
+    # inputs: features (np.ndarray), activations (np.ndarray), candidates (np.ndarray or list)
+    # outputs: features (np.ndarray), activations (np.ndarray)
+    def with_inactive_features(self, features, activations, candidates):
+        inactive = np.setdiff1d(np.asarray(candidates, dtype=np.int64), features)
+        return (np.concatenate((features, inactive)),
+                np.concatenate((activations, np.zeros(len(inactive), dtype=np.float32))))
+
+    # get the sentences that activate all the given features most strongly
+    # inputs: features (list), top_k (int)
+    # outputs: sentences (list of {'id', 'activation'}) or None while the activations are being built
+    def get_feature_sentences(self, features, top_k=10):
+        features = [int(feature) for feature in features]
+        if any(feature < 0 or feature >= len(self.features) for feature in features):
+            raise IndexError(f'features must be in [0, {len(self.features)})')
+        with self.embedding_store.lock:
+            result = self.activations.top_rows(features, top_k)
+            if result is None:
+                return None
+            rows, activations = result
+            positions = self.embedding_store.positions(rows)
+        return [{'id': int(position), 'activation': float(activation)}
+                for position, activation in zip(positions, activations)]
+
+    # invert embeddings to sentences with the given latency/quality mode
+    # inputs: embeddings (torch.Tensor), mode (string)
+    # outputs: sentences (list)
+    def invert_embeddings(self, embeddings, mode=default_inversion_mode):
+        if mode == 'adaptive':
+            return self.invert_embeddings_adaptive(embeddings)
+        return self.invert_embeddings_cached(embeddings, **inversion_modes[mode])
+
+    # invert embeddings to sentences, reusing cached inversions where possible
+    # inputs: embeddings (torch.Tensor), settings (kwargs for vec2text.invert_embeddings)
+    # outputs: sentences (list)
+    def invert_embeddings_cached(self, embeddings, **settings):
+        sentences = self.inversion_cache.get_many(
+            embeddings, settings, self.dataset)
+        missing = [i for i, s in enumerate(sentences) if s is None]
+        if missing:
+            missing_embeddings = embeddings[missing]
+            new_sentences = self.inverter.invert(missing_embeddings, **settings)
+            self.inversion_cache.put_many(
+                missing_embeddings, settings, new_sentences)
+            for i, s in zip(missing, new_sentences):
+                sentences[i] = s
+        print(f'{len(sentences) - len(missing)}/{len(sentences)} inversions cached')
+        return sentences
+
+    # invert embeddings with increasingly expensive modes, stopping for each
+    # embedding once its re-embedded hypothesis is close enough to the goal
+    # inputs: embeddings (torch.Tensor), target_cosine (float)
+    # outputs: sentences (list)
+    def invert_embeddings_adaptive(self, embeddings, target_cosine=adaptive_target_cosine):
+        targets = embeddings.to(torch.float32)
+        best_sentences = [None] * len(embeddings)
+        best_scores = [-1.0] * len(embeddings)
+        remaining = list(range(len(embeddings)))
+        for mode in adaptive_inversion_schedule:
+            sentences = self.invert_embeddings_cached(
+                embeddings[remaining], **inversion_modes[mode])
+            hypotheses = self.get_sentence_embeddings(
+                sentences).to(torch.float32).to(targets.device)
+            scores = torch.nn.functional.cosine_similarity(
+                hypotheses, targets[remaining], dim=1).tolist()
+            for i, sentence, score in zip(remaining, sentences, scores):
+                if score > best_scores[i]:
+                    best_sentences[i] = sentence
+                    best_scores[i] = score
+            remaining = [i for i in remaining if best_scores[i] < target_cosine]
+            print(f'[{mode}] {len(embeddings) - len(remaining)}/{len(embeddings)} '
+                  f'inversions reached cosine {target_cosine}')
+            if not remaining:
+                break
+        return best_sentences
 
     # for the given sentence, add the feature vectors and invert the
     # resultant embeddings to generate new sentences
-    # inputs: sentence (string), id (int), features_and_weights (list)
+    # inputs: sentence (string), id (int), features_and_weights (list), mode (string)
     # outputs: new_sentences (list)
-    def add_features_and_invert(self, sentence, id, features_and_weights):
+    def add_features_and_invert(self, sentence, id, features_and_weights, mode=default_inversion_mode):
         # features_and_weights is a list of dicts: {id: int, weight: float}
 
         # find the features for the given feature_ids + multiply by the weights
@@ -263,35 +538,162 @@ class SAE(object):
         # normalize the new embedding
         new_embedding = new_embedding / torch.norm(new_embedding)
         # invert the new embedding
-        new_sentence = vec2text.invert_embeddings(
-            new_embedding.unsqueeze(0), self.corrector)
+        new_sentence = self.invert_embeddings(new_embedding.unsqueeze(0), mode)
         return new_sentence
 
-    # project new embeddings to the UMAP space
-    # inputs: new_embeddings (list)
+    # place the sentences at their coordinates in the sentence store
+    # (the data file plus the positions recorded since)
+    def load_layout(self):
+        rows = self.sentence_store.rows
+        for row, sentence_id in enumerate(self.embedding_store.ids.tolist()):
+            point = rows.get(sentence_id)
+            if point is not None and 'umap_x' in point and 'umap_y' in point:
+                self.layout[row] = point['umap_x'], point['umap_y']
+
+    # make the embeddings and the sentence store agree after a crash between
+    # their writes, or for sentences added before the store kept their text:
+    # embeddings without a sentence are tombstoned, sentences without an embedding removed
+    def reconcile_sentences(self):
+        if not os.path.exists(self.sentence_store.data_file):
+            return
+        store = self.embedding_store
+        live_ids = store.ids[store.live_rows]
+        sentence_ids = self.sentence_store.ids
+        orphans = np.flatnonzero(~np.isin(live_ids, sentence_ids))
+        for position in orphans[::-1]:
+            store.remove(int(position))
+        stale = np.setdiff1d(sentence_ids, live_ids)
+        self.sentence_store.remove(stale)
+        if len(orphans) or len(stale):
+            print(f'{self.dataset} sentences reconciled: {len(orphans)} embeddings without text '
+                  f'removed, {len(stale)} sentences without embeddings removed')
+
+    # project new embeddings to the UMAP space, remembering the positions of
+    # the given storage rows for warm-started refits
+    # inputs: new_embeddings (list), rows (np.ndarray), projection (string)
     # outputs: new_umap_points (np.ndarray)
-    def project_new_points(self, new_embeddings):
+    def project_new_points(self, new_embeddings, rows=None, projection=default_projection_mode):
+        start_time = time.time()
         # convert list of tensors to numpy
         new_embeddings = new_embeddings.cpu().numpy()
         # convert to 2D array
         # check if the new_embeddings are 2D
         if new_embeddings.ndim == 1:
-            new_embeddings = new_embeddings.reshape(
-                new_embeddings.shape[0], -1)
-        new_umap_points = self.umap_reducer.transform(new_embeddings)
+            new_embeddings = new_embeddings.reshape(1, -1)
+        if projection == 'knn':
+            new_umap_points = self.project_knn(new_embeddings, rows)
+        else:
+            new_umap_points = self.umap_reducer.transform(new_embeddings)
+            if rows is not None:
+                self.record_layout(rows, new_umap_points)
+
+        metrics = self.projection_metrics[projection]
+        metrics['calls'] += 1
+        metrics['points'] += len(new_embeddings)
+        metrics['seconds'] += time.time() - start_time
+        return new_umap_points
+
+    # place embeddings at the similarity-weighted mean position of their k nearest
+    # already-placed neighbors (falling back to the umap transform when there are none)
+    # inputs: new_embeddings (np.ndarray), rows (np.ndarray or None)
+    # outputs: new_umap_points (np.ndarray)
+    def project_knn(self, new_embeddings, rows=None):
+        layout = self.layout
+        # the new rows are already in the index but not placed yet, so search a bit further
+        extra = 0 if rows is None else len(rows)
+        neighbors, scores = self.neighbor_index.search(
+            new_embeddings, knn_projection_k + extra)
+        placed = neighbors < len(layout)
+        placed[placed] = ~np.isnan(layout[neighbors[placed], 0])
+        if rows is not None:
+            # edited rows still have their old position; never place a point by itself
+            placed &= ~np.isin(neighbors, rows)
+        # keep the k best placed neighbors of each point
+        placed &= np.cumsum(placed, axis=1) <= knn_projection_k
+        weights = np.where(placed, np.clip(scores, 1e-6, None), 0.0)
+        coords = layout[np.where(placed, neighbors, 0)]
+        totals = weights.sum(axis=1, keepdims=True)
+        new_umap_points = (weights[:, :, None] * coords).sum(axis=1) / np.maximum(totals, 1e-12)
+
+        unplaced = totals[:, 0] == 0
+        if unplaced.any():
+            new_umap_points[unplaced] = self.umap_reducer.transform(new_embeddings[unplaced])
+        if rows is not None:
+            self.record_layout(rows, new_umap_points)
+            if knn_projection_refine:
+                self.refine_executor.submit(self.refine_layout, rows, new_embeddings)
         return new_umap_points
 
+    # replace approximate positions with the umap transform (runs in the background)
+    # inputs: rows (np.ndarray), new_embeddings (np.ndarray)
+    def refine_layout(self, rows, new_embeddings):
+        reducer = self.umap_reducer
+        new_umap_points = reducer.transform(new_embeddings)
+        # skip if a refit swapped the reducer meanwhile
+        if reducer is self.umap_reducer:
+            self.record_layout(rows, new_umap_points)
+            self.projection_metrics['knn']['refined'] += len(rows)
+
+    # store the 2d positions of storage rows
+    # inputs: rows (np.ndarray), points (np.ndarray)
+    def record_layout(self, rows, points):
+        with self.embedding_store.lock:
+            if len(self.layout) < len(self.embeddings):
+                grown = np.full((len(self.embeddings), 2), np.nan, dtype=np.float32)
+                grown[:len(self.layout)] = self.layout
+                self.layout = grown
+            self.layout[rows] = points
+            # persist the positions of the rows that were not removed meanwhile
+            rows = np.asarray(rows)
+            alive = self.embedding_store.alive[rows]
+            self.sentence_store.set(self.embedding_store.ids[rows[alive]], [
+                {'umap_x': float(x), 'umap_y': float(y)} for x, y in np.asarray(points)[alive]])
+
     # reembed all sentences with UMAP and return the new points
     # outputs: new_points (list)
     def reembed_all_sentences(self):
-        # reembed all sentences with new UMAP
-        all_embeddings = self.embeddings
-        new_umap = umap.UMAP(n_neighbors=100, min_dist=0.1,
-                             n_components=2, metric='cosine')
-        new_reducer = new_umap.fit(all_embeddings.cpu())
-        new_umap_points = new_reducer.transform(all_embeddings.cpu())
-
-        self.umap_reducer = new_reducer  # update the umap reducer
+        return self.refit_umap(None)
+
+    # fit a new UMAP reducer on all (non-removed) sentences and swap it in;
+    # the current reducer keeps serving projections until the swap
+    # inputs: job (utils.jobs.Job or None), warm_start (bool)
+    # outputs: new_points (list), one per sentence id at the start of the fit
+    def refit_umap(self, job, warm_start=False):
+        def update(progress, stage):
+            if job is not None:
+                job.update(progress, stage)
+            print(f'[umap refit] {stage}')
+
+        update(0.0, 'collecting embeddings')
+        with self.embedding_store.lock:
+            live_rows = self.embedding_store.live_rows.copy()
+            all_embeddings = self.embeddings[torch.from_numpy(live_rows)].cpu().numpy()
+            init = None
+            if warm_start:
+                init = np.full((len(live_rows), 2), np.nan, dtype=np.float32)
+                known = live_rows < len(self.layout)
+                init[known] = self.layout[live_rows[known]]
+
+        settings = dict(umap_settings)
+        if init is not None:
+            # start from the current layout; rows never projected get the current reducer's guess
+            missing = np.isnan(init).any(axis=1)
+            if missing.any():
+                update(0.05, f'projecting {int(missing.sum())} unplaced points')
+                init[missing] = self.umap_reducer.transform(all_embeddings[missing])
+            settings.update(init=init, n_epochs=umap_warm_start_epochs)
+
+        update(0.1, f'fitting {len(live_rows)} points')
+        new_reducer = umap.UMAP(**settings).fit(all_embeddings)
+        # the fit already computed the layout of its training points
+        new_umap_points = new_reducer.embedding_
+
+        update(0.95, 'swapping reducer')
+        with self.embedding_store.lock:
+            if job is not None:
+                job.check()  # never swap in the result of a cancelled job
+            self.umap_reducer = new_reducer  # update the umap reducer
+            self.record_layout(live_rows, new_umap_points)
 
         # format the sentences and umap points to return as a list of dict objects
         new_points = format_new_points_umap(
@@ -300,9 +702,10 @@ class SAE(object):
 
     # embed the new sentences, project the new embeddings to the UMAP space, and
     # format the new sentences and umap points to return as a list of dict objects
-    # inputs: sentences (list)
+    # inputs: sentences (list), gen_num (int), type (string), weights (list), projection (string)
     # outputs: new_points (list)
-    def embed_and_format_points(self, all_sentences, gen_num, type='generate', weights=[]):
+    def embed_and_format_points(self, all_sentences, gen_num, type='generate', weights=[],
+                                projection=default_projection_mode):
         # cut off the extra sentences if there are more than gen_num
         sentences = all_sentences[:gen_num]
 
@@ -310,9 +713,9 @@ class SAE(object):
         for s in sentences:
             print(s)
         # embed the new sentences
-        all_embeddings = self.add_sentence_embeddings(sentences)
+        all_embeddings, rows = self.add_sentence_embeddings(sentences)
         # project the new embeddings to the UMAP space
-        new_umap_points = self.project_new_points(all_embeddings)
+        new_umap_points = self.project_new_points(all_embeddings, rows, projection)
         # format the new sentences and umap points to return as a list of dict objects
         if type == 'generate':
             new_points = format_new_points(sentences, new_umap_points)
@@ -323,59 +726,105 @@ class SAE(object):
 
     # add the top features to the sentence and invert the embeddings
     # format the new sentences and umap points to return as a list of dict objects
-    # inputs: sentence (string), id (number), features_and_weights (list), gen_num (int)
+    # inputs: sentence (string), id (number), features_and_weights (list), gen_num (int),
+    #         mode (string), projection (string)
     # outputs: new_points (list)
-    def generate_new_points(self, sentence, id, features_and_weights, gen_num):
+    def generate_new_points(self, sentence, id, features_and_weights, gen_num, mode=default_inversion_mode,
+                            projection=default_projection_mode):
+        return collect_points(self.generate_new_points_stream(
+            sentence, id, features_and_weights, gen_num, mode, projection))
+
+    # streaming version of generate_new_points: yields stage and point events
+    # (see stage_event / point_event) as soon as each step is done
+    # inputs: sentence (string), id (number), features_and_weights (list), gen_num (int),
+    #         mode (string), projection (string)
+    # outputs: events (generator)
+    def generate_new_points_stream(self, sentence, id, features_and_weights, gen_num,
+                                   mode=default_inversion_mode, projection=default_projection_mode):
+        start_time = time.time()
         # add the features to the sentence and invert the embeddings
+        yield stage_event('invert', start_time)
         new_sentence = self.add_features_and_invert(
-            sentence, id, features_and_weights)
+            sentence, id, features_and_weights, mode)
         # correct the new sentence using the llm model
+        yield stage_event('correct', start_time)
         correct_start_time = time.time()
-        corrected_sentence = correct_sentence(self.llm, sentence, new_sentence)
+        corrected_sentence = self.llm.correct(sentence, new_sentence)
         correct_end_time = time.time()
         print('Sentence corrected in:', correct_end_time - correct_start_time)
 
-        # generate variations of the corrected sentence
+        # generate variations of the corrected sentence in parallel chunks
         extra_sentences_to_generate = gen_num - 1
         generate_start_time = time.time()
-        sentence_variations = generate_sentence_variations(
-            self.llm, extra_sentences_to_generate, corrected_sentence)
+        futures = [self.llm_pool.submit(self.llm.vary, n, corrected_sentence, chunk)
+                   for chunk, n in enumerate(chunk_counts(extra_sentences_to_generate, llm_chunk_size))]
+        # embed and send the corrected sentence while the variations are generated
+        yield stage_event('generate', start_time)
+        yield from self.embed_and_stream_chunks([[corrected_sentence]], gen_num, projection)
+        yield from self.embed_and_stream_chunks(
+            (sentences for _, sentences in self.llm_pool.as_completed(futures)), gen_num - 1, projection)
         generate_end_time = time.time()
         print(f'{extra_sentences_to_generate} variations generated in:',
               generate_end_time - generate_start_time)
 
-        # embed and format the new sentences
-        all_sentences = [corrected_sentence] + sentence_variations
-        new_points = self.embed_and_format_points(all_sentences, gen_num)
-
-        return new_points
-
     # generate new points using the language model
-    # inputs: sentence (string), gen_num (int), instruction (string)
+    # inputs: sentence (string), gen_num (int), instruction (string), projection (string)
     # outputs: new_points (list)
-    def generate_new_points_llm(self, sentence, gen_num, instruction):
-        generate_start_time = time.time()
-        new_sentences = prompt_for_sentence_variations_llm(
-            self.llm, sentence, gen_num, instruction)
-        generate_end_time = time.time()
-        print(f'{gen_num} variations generated in:',
-              generate_end_time - generate_start_time)
+    def generate_new_points_llm(self, sentence, gen_num, instruction, projection=default_projection_mode):
+        return collect_points(self.generate_new_points_llm_stream(sentence, gen_num, instruction, projection))
 
-        # embed and format the new sentences
-        new_points = self.embed_and_format_points(new_sentences, gen_num)
-
-        return new_points
+    # streaming version of generate_new_points_llm
+    # inputs: sentence (string), gen_num (int), instruction (string), projection (string)
+    # outputs: events (generator)
+    def generate_new_points_llm_stream(self, sentence, gen_num, instruction, projection=default_projection_mode):
+        start_time = time.time()
+        yield stage_event('generate', start_time)
+        futures = [self.llm_pool.submit(self.llm.instruct_vary, n, sentence, instruction, chunk)
+                   for chunk, n in enumerate(chunk_counts(gen_num, llm_chunk_size))]
+        yield from self.embed_and_stream_chunks(
+            (sentences for _, sentences in self.llm_pool.as_completed(futures)), gen_num, projection)
+        print(f'{gen_num} variations generated in:', time.time() - start_time)
+
+    # embed, project and send each chunk of new sentences as soon as it arrives
+    # inputs: chunks (iterable of sentence lists), gen_num (int), max number of points to send,
+    #         projection (string)
+    # outputs: events (generator)
+    def embed_and_stream_chunks(self, chunks, gen_num, projection=default_projection_mode):
+        remaining = gen_num
+        for chunk in chunks:
+            if remaining <= 0:
+                break
+            new_points = self.embed_and_format_points(
+                chunk, remaining, projection=projection)
+            remaining -= len(new_points)
+            for point in new_points:
+                yield point_event(point)
 
     # generate new points by interpolating between two sentences
-    # inputs: sent1 (string), id1 (int), sent2 (string), id2 (int), gen_num (int)
+    # inputs: sent1 (string), id1 (int), sent2 (string), id2 (int), gen_num (int), mode (string),
+    #         projection (string)
     # outputs: new_points (list)
-    def interpolate_between_points(self, sent1, id1, sent2, id2, gen_num):
-        # get the embeddings for the two sentences
+    def interpolate_between_points(self, sent1, id1, sent2, id2, gen_num, mode=default_inversion_mode,
+                                   projection=default_projection_mode):
+        return collect_points(self.interpolate_between_points_stream(
+            sent1, id1, sent2, id2, gen_num, mode, projection))
+
+    # streaming version of interpolate_between_points
+    # inputs: sent1 (string), id1 (int), sent2 (string), id2 (int), gen_num (int), mode (string),
+    #         projection (string)
+    # outputs: events (generator)
+    def interpolate_between_points_stream(self, sent1, id1, sent2, id2, gen_num, mode=default_inversion_mode,
+                                          projection=default_projection_mode):
+        start_time = time.time()
+        yield stage_event('embed', start_time)
+        # get the embeddings for the two sentences (embedding new ones in one batch)
         emb1 = self.get_existing_embedding(id1)
-        if emb1 is None:
-            emb1 = self.get_sentence_embedding(sent1)
         emb2 = self.get_existing_embedding(id2)
-        if emb2 is None:
+        if emb1 is None and emb2 is None:
+            emb1, emb2 = self.get_sentence_embeddings([sent1, sent2])
+        elif emb1 is None:
+            emb1 = self.get_sentence_embedding(sent1)
+        elif emb2 is None:
             emb2 = self.get_sentence_embedding(sent2)
 
         # Ensure embeddings are of float type
@@ -396,50 +845,96 @@ class SAE(object):
         new_embeddings = torch.stack(new_embeddings)  # convert to tensor
 
         # now invert all the new embeddings
+        yield stage_event('invert', start_time)
         time_start = time.time()
-        new_sentences = vec2text.invert_embeddings(
-            new_embeddings, self.corrector)
+        new_sentences = self.invert_embeddings(new_embeddings, mode)
         time_end = time.time()
 
         print(f'Interpolated {gen_num} sentences in:', time_end - time_start)
 
         # correct the new sentences using the llm model
+        yield stage_event('correct', start_time)
         time_start = time.time()
-        corrected_sentences = correct_multiple_sentences(
-            self.llm, new_sentences, sent1, sent2)
+        corrected_sentences = self.llm.correct_multiple(
+            new_sentences, sent1, sent2)
         time_end = time.time()
 
         print(f'Sentences corrected in:', time_end - time_start)
 
         # embed and format the new sentences
+        yield stage_event('project', start_time)
         new_points = self.embed_and_format_points(
-            corrected_sentences, gen_num, 'interpolate', weights)
-        return new_points
+            corrected_sentences, gen_num, 'interpolate', weights, projection)
+        for point in new_points:
+            yield point_event(point)
 
     # add new sentence manually to dataset
-    # inputs: sentence (string)
+    # inputs: sentence (string), projection (string)
     # outputs: new_points (list)
-    def add_new_sentence(self, sentence):
-        new_points = self.embed_and_format_points([sentence], 1)
+    def add_new_sentence(self, sentence, projection=default_projection_mode):
+        new_points = self.embed_and_format_points([sentence], 1, projection=projection)
         return new_points
 
     # edit sentence in dataset
-    # inputs: id (int), new_sentence (string)
+    # inputs: id (int), new_sentence (string), projection (string)
     # outputs: new_points (list)
-    def edit_sentence(self, id, new_sentence):
-        # remove the old embedding
-        new_embedding = self.get_sentence_embedding(new_sentence)
-        # replace embedding at id with new_embedding
-        self.embeddings[id] = new_embedding
-        # recompute the similarity matrix
-        new_sim_matrix = cosine_similarity(self.embeddings.cpu())
-        self.embed_sim_matrix = new_sim_matrix
+    def edit_sentence(self, id, new_sentence, projection=default_projection_mode):
+        return self.edit_sentences([id], [new_sentence], projection)
+
+    # edit several sentences at once: one embedding batch, one WAL write,
+    # one neighbor index update and one UMAP projection, touching only the edited rows
+    # inputs: ids (list), new_sentences (list), projection (string)
+    # outputs: new_points (list), in the order of ids
+    def edit_sentences(self, ids, new_sentences, projection=default_projection_mode):
+        new_embeddings = self.get_sentence_embeddings(new_sentences)
+        activations = self.encode_activations(new_embeddings)
+        # replace the embeddings at ids with new_embeddings
+        with self.embedding_store.lock:
+            rows = self.embedding_store.replace(ids, new_embeddings.cpu().numpy())
+            self.sentence_store.set(self.embedding_store.ids[rows],
+                                    [{'sentence': sentence} for sentence in new_sentences])
+            self.embeddings[torch.from_numpy(rows)] = new_embeddings.to(
+                self.device, self.embeddings.dtype)
+            self.activations.set_rows(rows, activations)
+            # update the neighbor index rows for these ids
+            self.neighbor_index.replace(rows, new_embeddings.cpu().numpy())
+        self.compact_embeddings()
+        self.save_activations()
         # project the new embeddings to the UMAP space
-        umap_points = self.project_new_points(new_embedding)
+        umap_points = self.project_new_points(new_embeddings, rows, projection)
         # format the new sentences and umap points to return as a list of dict objects
-        new_points = format_new_points([new_sentence], umap_points)
+        new_points = format_new_points(new_sentences, umap_points)
         return new_points
 
+    # bring the dataset in line with a client's copy of it: the client has
+    # total_sentences sentences, the last len(sentences) of them added to the
+    # original dataset; missing ones are added, differing ones edited and any
+    # beyond total_sentences removed
+    # inputs: sentences (list), total_sentences (int), projection (string)
+    # outputs: counts (dict) of the added, edited and removed sentences
+    def sync_sentences(self, sentences, total_sentences, projection=default_projection_mode):
+        first = total_sentences - len(sentences)
+        current = [row.get('sentence') for row in self.sentence_store.live_rows()]
+        if first < 0 or first > len(current):
+            raise ValueError(f'{self.dataset} has {len(current)} sentences, the client '
+                             f'added {len(sentences)} to its {first} original ones')
+
+        removed = max(len(current) - total_sentences, 0)
+        for position in range(len(current) - 1, total_sentences - 1, -1):
+            self.remove_embedding(position)
+        current = current[:total_sentences]
+
+        edits = [(first + i, sentence) for i, sentence in enumerate(sentences[:len(current) - first])
+                 if current[first + i] != sentence]
+        if edits:
+            self.edit_sentences([position for position, _ in edits],
+                                [sentence for _, sentence in edits], projection)
+
+        added = sentences[len(current) - first:]
+        if added:
+            self.embed_and_format_points(added, len(added), projection=projection)
+        return {'added': len(added), 'edited': len(edits), 'removed': removed}
+
     # add prompt ideas to the dictionary for the given sentence
     # inputs: sentence (string), prompts (list)
 
@@ -460,7 +955,7 @@ class SAE(object):
 
         # else, generate prompt ideas for the given sentence
         start_time = time.time()
-        prompts = generate_prompt_ideas(self.llm, gen_num, sentence)
+        prompts = self.llm.prompt_ideas(gen_num, sentence)
         end_time = time.time()
         print(f'{gen_num} prompt ideas generated in:', end_time - start_time)
         for prompt in prompts:
@@ -3,7 +3,7 @@ For licensing see accompanying LICENSE file.
 Copyright (C) 2024 Apple Inc. All Rights Reserved.
 """
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 import os
 from os.path import dirname, abspath, join
@@ -13,7 +13,10 @@ from datetime import datetime
 import numpy as np
 
 from helpers import convert_points_to_serializable, load_models
-from sae import SAE
+from sae import SAE, default_inversion_mode, default_projection_mode, inversion_mode_names, projection_mode_names
+from utils.data_cache import DataPayloadCache
+from utils.dataset_registry import DatasetRegistry
+from utils.jobs import JobManager
 
 # get current date
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -32,28 +35,119 @@ model_dict = load_models()
 python_version = model_dict['python_version']
 print('-----------------------------------')
 
-""" UPDATE HERE IF YOU ADD A NEW DATASET """
-# load SAEs
-sae_wiki = SAE(model_dict, dataset='wiki')
-print('-----------------------------------')
-sae_chi = SAE(model_dict, dataset='chi')
-print('-----------------------------------')
-sae_hcslab = SAE(model_dict, dataset='hcslab')
-print('-----------------------------------')
-sae_cps = SAE(model_dict, dataset='cps')
-print('-----------------------------------')
-sae_chi25 = SAE(model_dict, dataset='chi2025')
-print('-----------------------------------')
+# datasets are listed in datasets.json; each SAE is built on first use
+# and the least recently used ones are evicted beyond the configured limits
+with open('datasets.json') as f:
+    dataset_config = json.load(f)
+
+SAE_REGISTRY = DatasetRegistry(
+    lambda dataset: SAE(model_dict, dataset=dataset),
+    dataset_config['datasets'].keys(),
+    max_resident=dataset_config.get('max_resident', 3),
+    memory_budget=dataset_config['memory_budget_mb'] * 1024 * 1024
+    if dataset_config.get('memory_budget_mb') else None)
+
+for dataset, config in dataset_config['datasets'].items():
+    if config.get('preload'):
+        SAE_REGISTRY.get(dataset)
+        print('-----------------------------------')
+
+# lease a dataset's SAE until the request ends, so an eviction does not close it mid-request
+# inputs: dataset (str)
+# outputs: sae (SAE)
+
+
+def get_sae(dataset):
+    sae = SAE_REGISTRY.acquire(dataset)
+    g.setdefault('leases', []).append(dataset)
+    return sae
+
+
+# release the leases taken by get_sae, unless a streaming response took them over
+@app.teardown_request
+def release_leases(exc):
+    for dataset in g.pop('leases', []):
+        SAE_REGISTRY.release(dataset)
+
+
+# parsed + precompressed dataset payloads served by /data/<dataset>
+data_cache = DataPayloadCache()
+DATA_MIMETYPES = {'json': 'application/json',
+                  'columnar': 'application/octet-stream'}
+
+# background jobs (UMAP refits), one at a time per dataset
+jobs = JobManager(max_workers=1)
+
+# time-to-first-point and total time of the streaming endpoints
+stream_metrics = {}
+
+# format an event as a server-sent event message
+# inputs: event (str), data (dict)
+# outputs: message (str)
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-SAE_DICT = {
-    'wiki': sae_wiki,
-    'chi': sae_chi,
-    'hcslab': sae_hcslab,
-    'cps': sae_cps,
-    'chi2025': sae_chi25
-}
+# record the latency of a finished stream
+# inputs: endpoint (str), time_to_first_point (float or None), total_time (float)
 
-""" END UPDATE """
+
+def record_stream_metrics(endpoint, time_to_first_point, total_time):
+    metrics = stream_metrics.setdefault(endpoint, {
+        'streams': 0, 'time_to_first_point_sum': 0.0, 'total_time_sum': 0.0})
+    metrics['streams'] += 1
+    metrics['time_to_first_point_sum'] += time_to_first_point or total_time
+    metrics['total_time_sum'] += total_time
+    metrics['mean_time_to_first_point'] = metrics['time_to_first_point_sum'] / \
+        metrics['streams']
+    metrics['mean_total_time'] = metrics['total_time_sum'] / metrics['streams']
+
+# stream the stage and point events of a pipeline as server-sent events
+# inputs: endpoint (str), events (generator)
+# outputs: response (flask.Response)
+
+
+def stream_events(endpoint, events):
+    start_time = time.time()
+
+    def generate():
+        time_to_first_point = None
+        num_points = 0
+        try:
+            for event in events:
+                if event['event'] == 'point':
+                    if time_to_first_point is None:
+                        time_to_first_point = time.time() - start_time
+                        print('Time to first point:', time_to_first_point)
+                    num_points += 1
+                    data = convert_points_to_serializable([event['point']])[0]
+                else:
+                    data = {k: v for k, v in event.items() if k != 'event'}
+                yield format_sse(event['event'], data)
+        except Exception as e:
+            print(f"Error streaming {endpoint}: {str(e)}")
+            yield format_sse('error', {'error': 'Failed to generate points'})
+            return
+
+        total_time = time.time() - start_time
+        record_stream_metrics(endpoint, time_to_first_point, total_time)
+        print('Done! Time elapsed:', total_time)
+        print('-----------------------------------')
+        yield format_sse('done', {'num_points': num_points,
+                                  'time_to_first_point': time_to_first_point,
+                                  'total_time': total_time})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # the stream outlives the view: keep the request's leases until the response is closed
+    leases = g.pop('leases', [])
+
+    def release_stream_leases():
+        for dataset in leases:
+            SAE_REGISTRY.release(dataset)
+    response.call_on_close(release_stream_leases)
+    return response
 
 # Path to read data
 
@@ -61,16 +155,40 @@ SAE_DICT = {
 @app.route("/data/<dataset>", methods=['GET'])
 def read_data(dataset):
     time_start = time.time()
-
-    dataset_name = f"{dataset}_data.json"
-    d = json.load(open(join(rootDir, 'data', dataset, dataset_name), 'r'))
+    if dataset not in SAE_REGISTRY:
+        return jsonify({'error': f'Unknown dataset: {dataset}'}), 404
+    data_format = request.args.get('format', 'json')
+    if data_format not in DATA_MIMETYPES:
+        return jsonify({'error': f'Invalid format, expected one of {list(DATA_MIMETYPES)}'}), 400
+
+    # the live sentences: the dataset file plus the journal of changes the SAE
+    # writes (utils/sentence_store.py), served without loading the dataset's SAE
+    dataset_folder = join(rootDir, 'data', dataset)
+    payload = data_cache.get(join(dataset_folder, f"{dataset}_data.json"),
+                             join(dataset_folder, f"{dataset}_sentences.jsonl"))
     print("New dataset:", dataset)
-    time_end = time.time()
-    print('Embeddings shape:', SAE_DICT[dataset].embeddings.shape)
+    print('Sentences:', payload.num_rows)
+
+    etag = payload.etags[data_format]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        # pick the best precompressed variant the client accepts
+        variants = payload.variants[data_format]
+        encoding = next((e for e in ['br', 'gzip'] if e in variants and request.accept_encodings[e]),
+                        'identity')
+        response = Response(
+            variants[encoding], mimetype=DATA_MIMETYPES[data_format])
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
 
+    time_end = time.time()
     print("Data loaded! Time elapsed: {} seconds".format(time_end - time_start))
     print('-----------------------------------')
-    return d
+    return response
 
 # Path to get top activations from sentence
 
@@ -80,23 +198,33 @@ def get_top_activations():
     dataset = request.args.get('dataset')
     sentence = request.args.get('sentence')
     id = request.args.get('id')
+    limit = request.args.get('limit')  # max active features returned, all features with info if unset
 
     if not dataset or not sentence or not id:
         return jsonify({'error': 'Dataset, sentence, and id are required'}), 400
 
-    id = int(id)
+    try:
+        id = int(id)
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        return jsonify({'error': 'ID and limit must be integers'}), 400
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
 
     print('Getting top features for sentence:', sentence)
-    sae = SAE_DICT[dataset]
+    sae = get_sae(dataset)
+    # ids can go stale on the frontend after a removal
+    if sae.embedding_store.row(id) is None:
+        return jsonify({'error': f'Unknown sentence id: {id}'}), 400
     top_features, similar_features = sae.get_top_activations_from_sentence(
-        sentence, id)
+        sentence, id, limit=limit)
     print(f'Found {len(similar_features)} similar features')
 
-    # this is a df so we need to convert it to json
-    top_features = top_features.to_dict(orient='records')
-
     print('Getting neighbors for feature:', id)
-    neighbors = sae.get_top_neighbors(id)
+    try:
+        neighbors = sae.get_top_neighbors(id)
+    except IndexError as e:  # removed concurrently
+        return jsonify({'error': str(e)}), 400
 
     # Convert neighbors to a list if it's a NumPy array
     if isinstance(neighbors, np.ndarray):
@@ -108,17 +236,53 @@ def get_top_activations():
     return jsonify(result)
 
 
+# Path to get the sentences that most strongly activate a set of features
+
+
+@app.route("/feature_sentences", methods=['GET'])
+def get_feature_sentences():
+    dataset = request.args.get('dataset')
+    features = request.args.get('features')  # comma separated, all must be active
+    if not dataset or not features:
+        return jsonify({'error': 'Dataset and features are required'}), 400
+    try:
+        features = [int(feature) for feature in features.split(',')]
+        top_k = int(request.args.get('top_k', 10))
+    except ValueError:
+        return jsonify({'error': 'Features and top_k must be integers'}), 400
+    if top_k < 1:
+        return jsonify({'error': 'top_k must be positive'}), 400
+
+    start_time = time.time()
+    sae = get_sae(dataset)
+    try:
+        sentences = sae.get_feature_sentences(features, top_k)
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 400
+    if sentences is None:
+        return jsonify({'error': 'Activations are still being built, try again shortly'}), 503
+    return jsonify({'features': features, 'sentences': sentences,
+                    'elapsed': time.time() - start_time})
+
+
 # path to generate new points from sentence and set of features
 @app.route("/generate_points", methods=['GET'])
+@app.route("/generate_points_stream", methods=['GET'])
 def generate_points():
     dataset = request.args.get('dataset')
     sentence = request.args.get('sentence')
     id = request.args.get('sent_id')
     features = request.args.get('feature_ids')
     gen_num = request.args.get('gen_num')
+    mode = request.args.get('mode', default_inversion_mode)
+    projection = request.args.get('projection', default_projection_mode)
 
     if not dataset or not sentence or not id or not gen_num or not features:
         return jsonify({'error': 'Dataset, sentence, id, gen_num, and feature_ids are required'}), 400
+    if mode not in inversion_mode_names:
+        return jsonify({'error': f'Invalid mode, expected one of {inversion_mode_names}'}), 400
+    if projection not in projection_mode_names:
+        return jsonify({'error': f'Invalid projection, expected one of {projection_mode_names}'}), 400
 
     gen_num = int(gen_num)
     print(f'[SAE] Generating {gen_num} new points for sentence:', sentence)
@@ -129,11 +293,15 @@ def generate_points():
                 for f in features]
     print('With features:', features)
 
+    sae = get_sae(dataset)
+    if request.path.endswith('_stream'):
+        return stream_events('generate_points', sae.generate_new_points_stream(
+            sentence, int(id), features, gen_num, mode, projection))
+
     start_time = time.time()
-    sae = SAE_DICT[dataset]
     # generated_points = sae.generate_new_points(sentence, int(id), features)
     generated_points = sae.generate_new_points(
-        sentence, int(id), features, gen_num)
+        sentence, int(id), features, gen_num, mode, projection)
     end_time = time.time()
     total_time = end_time - start_time
 
@@ -149,22 +317,31 @@ def generate_points():
 
 
 @app.route("/generate_points_llm", methods=['GET'])
+@app.route("/generate_points_llm_stream", methods=['GET'])
 def generate_points_llm():
     dataset = request.args.get('dataset')
     sentence = request.args.get('sentence')
     prompt = request.args.get('prompt')
     gen_num = request.args.get('gen_num')
+    projection = request.args.get('projection', default_projection_mode)
 
     if not dataset or not sentence or not prompt or not gen_num:
         return jsonify({'error': 'Dataset, sentence, prompt, and gen_num are required'}), 400
+    if projection not in projection_mode_names:
+        return jsonify({'error': f'Invalid projection, expected one of {projection_mode_names}'}), 400
 
     gen_num = int(gen_num)
     print(f'[LLM] Generating {gen_num} new points for sentence:', sentence)
     print('With prompt:', prompt)
 
+    sae = get_sae(dataset)
+    if request.path.endswith('_stream'):
+        return stream_events('generate_points_llm', sae.generate_new_points_llm_stream(
+            sentence, gen_num, prompt, projection))
+
     start_time = time.time()
-    sae = SAE_DICT[dataset]
-    generated_points = sae.generate_new_points_llm(sentence, gen_num, prompt)
+    generated_points = sae.generate_new_points_llm(
+        sentence, gen_num, prompt, projection)
     end_time = time.time()
     total_time = end_time - start_time
 
@@ -179,6 +356,7 @@ def generate_points_llm():
 
 
 @app.route("/interpolate_points", methods=['GET'])
+@app.route("/interpolate_points_stream", methods=['GET'])
 def interpolate_points():
     dataset = request.args.get('dataset')
     sent1 = request.args.get('sent1')
@@ -186,18 +364,28 @@ def interpolate_points():
     sent2 = request.args.get('sent2')
     id2 = request.args.get('id2')
     gen_num = request.args.get('gen_num')
+    mode = request.args.get('mode', default_inversion_mode)
+    projection = request.args.get('projection', default_projection_mode)
 
     if not dataset or not sent1 or not id1 or not sent2 or not id2 or not gen_num:
         return jsonify({'error': 'Dataset, sent1, id1, sent2, id2, and gen_num are required'}), 400
+    if mode not in inversion_mode_names:
+        return jsonify({'error': f'Invalid mode, expected one of {inversion_mode_names}'}), 400
+    if projection not in projection_mode_names:
+        return jsonify({'error': f'Invalid projection, expected one of {projection_mode_names}'}), 400
 
     gen_num = int(gen_num)
     print(
         f'[INT] Interpolating {gen_num} new points between sentences:', sent1, 'and', sent2)
 
+    sae = get_sae(dataset)
+    if request.path.endswith('_stream'):
+        return stream_events('interpolate_points', sae.interpolate_between_points_stream(
+            sent1, int(id1), sent2, int(id2), gen_num, mode, projection))
+
     start_time = time.time()
-    sae = SAE_DICT[dataset]
     interpolated_points = sae.interpolate_between_points(
-        sent1, int(id1), sent2, int(id2), gen_num)
+        sent1, int(id1), sent2, int(id2), gen_num, mode, projection)
     end_time = time.time()
     total_time = end_time - start_time
 
@@ -219,11 +407,14 @@ def add_sentence_manual():
 
     dataset = data.get('dataset')
     sentence = data.get('sentence')
+    projection = data.get('projection', default_projection_mode)
+    if projection not in projection_mode_names:
+        return jsonify({'error': f'Invalid projection, expected one of {projection_mode_names}'}), 400
     print('Adding sentence to dataset:', sentence)
 
     start_time = time.time()
-    sae = SAE_DICT[dataset]
-    new_points = sae.add_new_sentence(sentence)
+    sae = get_sae(dataset)
+    new_points = sae.add_new_sentence(sentence, projection)
     serializable_points = convert_points_to_serializable(new_points)
     end_time = time.time()
     total_time = end_time - start_time
@@ -245,7 +436,7 @@ def remove_sentence():
         id = int(id)
         print(f'Removing point: {id}')
 
-        sae = SAE_DICT[dataset]
+        sae = get_sae(dataset)
         sae.remove_embedding(id)
         print('-----------------------------------')
         return jsonify({'success': True, 'message': 'Point removed successfully'})
@@ -268,16 +459,19 @@ def edit_sentence():
     dataset = data.get('dataset')
     id = data.get('id')
     new_sentence = data.get('new_sentence')
+    projection = data.get('projection', default_projection_mode)
     if not dataset or not id or not new_sentence:
         return jsonify({'error': 'Dataset, ID, and new_sentence are required'}), 400
+    if projection not in projection_mode_names:
+        return jsonify({'error': f'Invalid projection, expected one of {projection_mode_names}'}), 400
 
     try:
         id = int(id)
         print(f'Editing sentence {id} in dataset:', dataset)
         print('New sentence:', new_sentence)
 
-        sae = SAE_DICT[dataset]
-        new_points = sae.edit_sentence(id, new_sentence)
+        sae = get_sae(dataset)
+        new_points = sae.edit_sentence(id, new_sentence, projection)
         serializable_points = convert_points_to_serializable(new_points)
         print('-----------------------------------')
         return jsonify({'success': True, 'data': serializable_points})
@@ -287,6 +481,46 @@ def edit_sentence():
         print(f"Error editing embedding: {str(e)}")
         return jsonify({'error': 'Failed to edit point'}), 500
 
+# path to edit many sentences in dataset with one index update
+
+
+@app.route("/edit_sentences", methods=['PUT'])
+def edit_sentences():
+    data = request.json
+    if not data:
+        return jsonify({'error': 'No data received'}), 400
+
+    dataset = data.get('dataset')
+    edits = data.get('edits')  # [{'id': int, 'new_sentence': str}, ...]
+    projection = data.get('projection', default_projection_mode)
+    if not dataset or not edits:
+        return jsonify({'error': 'Dataset and edits are required'}), 400
+    if projection not in projection_mode_names:
+        return jsonify({'error': f'Invalid projection, expected one of {projection_mode_names}'}), 400
+
+    try:
+        ids = [int(edit['id']) for edit in edits]
+        new_sentences = [edit['new_sentence'] for edit in edits]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Each edit needs an integer id and a new_sentence'}), 400
+    if len(set(ids)) != len(ids):
+        return jsonify({'error': 'Each ID can only be edited once per request'}), 400
+
+    try:
+        print(f'Editing {len(ids)} sentences in dataset:', dataset)
+        start_time = time.time()
+        sae = get_sae(dataset)
+        new_points = sae.edit_sentences(ids, new_sentences, projection)
+        serializable_points = convert_points_to_serializable(new_points)
+        print('Done! Time elapsed:', time.time() - start_time)
+        print('-----------------------------------')
+        return jsonify({'success': True, 'data': serializable_points})
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error editing embeddings: {str(e)}")
+        return jsonify({'error': 'Failed to edit points'}), 500
+
 # path to add multiple embeddings to dataset
 
 
@@ -305,14 +539,16 @@ def add_sentences():
         return jsonify({'error': error_msg}), 400
 
     try:
-        sae = SAE_DICT[dataset]
-        existing_emb_length = len(sae.embeddings)
-        if existing_emb_length >= total_sentences:
+        sae = get_sae(dataset)
+        # reconcile with the client's sentences instead of trusting the count alone
+        counts = sae.sync_sentences(sentences, int(total_sentences))
+        if not any(counts.values()):
             return jsonify({'success': True, 'message': 'No new points need to be added'})
-        print(f'Adding {len(sentences)} points to dataset')
-        sae.add_sentence_embeddings(sentences)
+        print(f'Synced points with the client: {counts}')
         print('-----------------------------------')
-        return jsonify({'success': True, 'message': 'Points added successfully'})
+        return jsonify({'success': True, 'message': 'Points synced successfully', **counts})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error adding embeddings: {str(e)}")
         return jsonify({'error': 'Failed to add points'}), 500
@@ -327,7 +563,7 @@ def get_prompt_ideas():
     if not dataset or not sentence:
         return jsonify({'error': 'Dataset and sentence are required'}), 400
     print('Getting prompts for sentence:', sentence)
-    sae = SAE_DICT[dataset]
+    sae = get_sae(dataset)
     prompt_ideas = sae.get_prompt_ideas(sentence)
     result = {'prompt_ideas': prompt_ideas}
     print('-----------------------------------')
@@ -343,11 +579,34 @@ def reembed_sentences():
         return jsonify({'error': 'No data received'}), 400
 
     dataset = data.get('dataset')
-    sae = SAE_DICT[dataset]
-    new_points = sae.reembed_all_sentences()
-    serializable_points = convert_points_to_serializable(new_points)
+    if dataset not in SAE_REGISTRY:
+        return jsonify({'error': f'Unknown dataset: {dataset}'}), 404
+    warm_start = bool(data.get('warm_start', False))
+
+    # a dataset has at most one refit in flight
+    job = jobs.active('umap_refit', dataset=dataset)
+    if job is None:
+        def refit(job):
+            with SAE_REGISTRY.lease(dataset) as sae:
+                return convert_points_to_serializable(sae.refit_umap(job, warm_start))
+        job = jobs.submit('umap_refit', refit,
+                          meta={'dataset': dataset, 'warm_start': warm_start}, queue=dataset)
+        print(f'UMAP refit job {job.id} started for {dataset}')
     print('-----------------------------------')
-    return serializable_points
+    return jsonify(job.to_dict(include_result=False)), 202
+
+# path to poll or cancel a background job
+
+
+@app.route("/jobs/<job_id>", methods=['GET', 'DELETE'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job: {job_id}'}), 404
+    if request.method == 'DELETE':
+        job.cancel()
+        print(f'{job.kind} job {job.id} cancelled')
+    return jsonify(job.to_dict())
 
 # path to download data
 
@@ -381,6 +640,29 @@ def download_data():
 
     return jsonify({'success': True, 'message': 'Data downloaded successfully'})
 
+# path to get cache statistics
+
+
+@app.route("/stats", methods=['GET'])
+def get_stats():
+    result = {'embedding_cache': model_dict['embedding_cache'].stats(),
+              'inversion_scheduler': model_dict['inverter'].stats(),
+              'inversion_cache': model_dict['inversion_cache'].stats(),
+              'llm_cache': model_dict['llm_cache'].stats(),
+              'llm_pool': model_dict['llm_pool'].stats(),
+              'datasets': SAE_REGISTRY.stats(),
+              'jobs': jobs.stats(),
+              'embedding_stores': {name: sae.embedding_store.stats()
+                                   for name, sae in SAE_REGISTRY.resident().items()},
+              'sentence_stores': {name: sae.sentence_store.stats()
+                                  for name, sae in SAE_REGISTRY.resident().items()},
+              'projection': {name: sae.projection_metrics
+                             for name, sae in SAE_REGISTRY.resident().items()},
+              'activations': {name: sae.activations.stats()
+                              for name, sae in SAE_REGISTRY.resident().items()},
+              'streaming': stream_metrics}
+    return jsonify(result)
+
 # Path for main Svelte page
 
 
@@ -5,8 +5,15 @@ Copyright (C) 2024 Apple Inc. All Rights Reserved.
 Test functions.
 """
 
+import os
+
+import torch
+
 from helpers import load_models
-from sae import SAE
+from sae import SAE, data_folder, model_folder
+from utils.dataset_registry import DatasetRegistry
+from utils.sae_inference import PRECISIONS, InferenceSAE, compare_inference
+from utils.sparse_autoencoder import SparseAutoencoder
 
 def test_top_activations(sae, sentence):
     print('TEST 1: get_top_activations')
@@ -70,6 +77,58 @@ def test_generate_prompts(sae, sentence):
     return prompts
 
 
+def test_sae_inference(name='wiki', n=256, top_k=32):
+    print('TEST 8: sae_inference')
+    print('comparing reduced-precision sae inference with float32 for', name)
+    sae_model = SparseAutoencoder.from_safetensors_file(
+        model_folder + f'{name}_model.safetensors')
+    sae_model.eval()
+    sae_model.requires_grad_(False)
+    # real dataset embeddings if available, else unit-norm inputs like the gtr embeddings
+    emb_file = data_folder + f'{name}/{name}_embeddings.pt'
+    if os.path.exists(emb_file):
+        x = torch.load(emb_file, map_location='cpu')[:n].to(torch.float32)
+    else:
+        x = torch.nn.functional.normalize(torch.randn(n, sae_model.n_inputs), dim=1)
+    reports = []
+    for precision in PRECISIONS:
+        report = compare_inference(sae_model, InferenceSAE(sae_model, precision), x, top_k)
+        # activation_cosine and top_k_overlap measure parity with the float32 model
+        print(report)
+        reports.append(report)
+    return reports
+
+
+def test_dataset_registry_lease():
+    print('TEST 9: dataset_registry_lease')
+    print('evicting a dataset while a request holds a lease on it')
+
+    class Dataset:
+        def __init__(self, name):
+            self.name = name
+            self.closed = False
+
+        def memory_footprint(self):
+            return 0
+
+        def close(self):
+            self.closed = True
+
+    registry = DatasetRegistry(Dataset, ['a', 'b'], max_resident=1)
+    with registry.lease('a') as a:
+        registry.get('b')  # evicts a
+        assert 'a' not in registry.resident()
+        assert not a.closed, 'a leased dataset was closed on eviction'
+    assert a.closed, 'the evicted dataset was not closed on its last release'
+
+    # an unleased dataset is closed as soon as it is evicted
+    b = registry.get('b')
+    registry.get('a')
+    assert b.closed
+    assert registry.stats()['leases'] == {} and registry.stats()['retired'] == []
+    print('ok')
+
+
 def main():
     model_dict = load_models()
     dataset = 'redteam'
@@ -108,6 +167,10 @@ def main():
 
     # test_generate_prompts(sae, sentence)
 
+    # test_sae_inference()
+
+    # test_dataset_registry_lease()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,261 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Dataset-wide sparse SAE activations.
+
+Activations above a threshold are kept as a rows x features CSR matrix
+(indptr / indices / data arrays), one row per embedding storage row. The
+file written by `save` uses the same keys as scipy.sparse.save_npz, so it
+can be opened with scipy.sparse.load_npz for offline analysis.
+
+Rows changed after the CSR arrays were built (added, edited or removed
+sentences) are kept in a small per-row overlay that takes precedence over
+the base arrays and is merged back by `compact`. An inverted FeatureIndex
+over the base arrays answers "which rows activate feature f" queries,
+combined with the overlay.
+"""
+
+import os
+import threading
+from typing import Iterable
+
+import numpy as np
+
+from utils.feature_index import FeatureIndex
+
+EMPTY_INDICES = np.empty(0, dtype=np.int32)
+EMPTY_VALUES = np.empty(0, dtype=np.float32)
+
+
+# keep the activations above the threshold of each dense row
+# inputs: dense (np.ndarray), rows x features, threshold (float)
+# outputs: list of (indices, values) per row
+def sparsify(dense: np.ndarray, threshold: float) -> list[tuple[np.ndarray, np.ndarray]]:
+    dense = np.atleast_2d(dense)
+    rows = []
+    for row in dense:
+        indices = np.flatnonzero(row > threshold).astype(np.int32)
+        rows.append((indices, row[indices].astype(np.float32)))
+    return rows
+
+
+# build CSR arrays from dense activation chunks, in row order
+# inputs: chunks (iterable of np.ndarray, rows x features), threshold (float)
+# outputs: indptr (np.ndarray), indices (np.ndarray), data (np.ndarray)
+def build_csr(chunks: Iterable[np.ndarray], threshold: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    counts, indices, data = [], [], []
+    for chunk in chunks:
+        chunk_rows, chunk_cols = np.nonzero(chunk > threshold)
+        counts.append(np.bincount(chunk_rows, minlength=len(chunk)))
+        indices.append(chunk_cols.astype(np.int32))
+        data.append(chunk[chunk_rows, chunk_cols].astype(np.float32))
+    indptr = np.zeros(sum(len(c) for c in counts) + 1, dtype=np.int64)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+    return (indptr,
+            np.concatenate(indices) if indices else EMPTY_INDICES,
+            np.concatenate(data) if data else EMPTY_VALUES)
+
+
+class ActivationMatrix:
+    """CSR activations by storage row plus an overlay of changed rows.
+
+    `row()` returns None for rows that are not known yet (while the base
+    arrays are still being built), so callers can fall back to the encoder.
+    Rebuilding the base arrays and their feature index happens outside the
+    lock, so lookups are never blocked by a compaction.
+    """
+
+    def __init__(self, n_features: int, threshold: float):
+        self.n_features = n_features
+        self.threshold = threshold
+        self.indptr = None
+        self.indices = EMPTY_INDICES
+        self.data = EMPTY_VALUES
+        self.feature_index = None
+        self._overrides: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self.lock = threading.RLock()
+        self.lookups = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.indptr is not None
+
+    @property
+    def base_rows(self) -> int:
+        return 0 if self.indptr is None else len(self.indptr) - 1
+
+    @property
+    def n_rows(self) -> int:
+        with self.lock:
+            return max([self.base_rows] + [row + 1 for row in self._overrides])
+
+    def set_base(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray):
+        feature_index = FeatureIndex(indptr, indices, data, self.n_features)
+        with self.lock:
+            self.indptr, self.indices, self.data = indptr, indices, data
+            self.feature_index = feature_index
+
+    # overwrite rows from dense activations
+    # inputs: rows (np.ndarray), dense (np.ndarray), len(rows) x features
+    def set_rows(self, rows, dense: np.ndarray):
+        with self.lock:
+            for row, entry in zip(np.atleast_1d(rows), sparsify(dense, self.threshold)):
+                self._overrides[int(row)] = entry
+
+    # empty rows (removed sentences)
+    # inputs: rows (np.ndarray)
+    def clear_rows(self, rows):
+        with self.lock:
+            for row in np.atleast_1d(rows):
+                self._overrides[int(row)] = (EMPTY_INDICES, EMPTY_VALUES)
+
+    # active features of a row
+    # inputs: row (int)
+    # outputs: (indices, values) or None if the row is not known yet
+    def row(self, row: int) -> tuple[np.ndarray, np.ndarray] | None:
+        with self.lock:
+            self.lookups += 1
+            if row in self._overrides:
+                return self._overrides[row]
+            if row < self.base_rows:
+                start, end = self.indptr[row], self.indptr[row + 1]
+                return self.indices[start:end], self.data[start:end]
+            return None
+
+    # merge the overlay into the CSR arrays
+    def compact(self):
+        with self.lock:
+            if not self._overrides or not self.ready:
+                return
+            overrides = dict(self._overrides)
+            old_indptr, old_indices, old_data = self.indptr, self.indices, self.data
+        base_rows = len(old_indptr) - 1
+        n_rows = max([base_rows] + [row + 1 for row in overrides])
+
+        counts = np.zeros(n_rows, dtype=np.int64)
+        counts[:base_rows] = np.diff(old_indptr)
+        for row, (row_indices, _) in overrides.items():
+            counts[row] = len(row_indices)
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        data = np.empty(indptr[-1], dtype=np.float32)
+        # copy the entries of unchanged base rows, then the overlay rows
+        changed = np.zeros(n_rows, dtype=bool)
+        changed[list(overrides)] = True
+        entry_rows = np.repeat(np.arange(base_rows), np.diff(old_indptr))
+        keep = np.flatnonzero(~changed[entry_rows])
+        kept_rows = entry_rows[keep]
+        target = indptr[kept_rows] + (keep - old_indptr[kept_rows])
+        indices[target] = old_indices[keep]
+        data[target] = old_data[keep]
+        for row, (row_indices, row_values) in overrides.items():
+            indices[indptr[row]:indptr[row + 1]] = row_indices
+            data[indptr[row]:indptr[row + 1]] = row_values
+        feature_index = FeatureIndex(indptr, indices, data, self.n_features)
+
+        with self.lock:
+            if self.indptr is not old_indptr:
+                return  # compacted concurrently
+            self.indptr, self.indices, self.data = indptr, indices, data
+            self.feature_index = feature_index
+            # keep overlay entries that changed again meanwhile
+            for row, entry in overrides.items():
+                if self._overrides.get(row) is entry:
+                    del self._overrides[row]
+
+    # rows that activate all the given features, by descending summed activation
+    # inputs: features (list), top_k (int)
+    # outputs: rows (np.ndarray), scores (np.ndarray), or None if not built yet
+    def top_rows(self, features: list[int], top_k: int = 10) -> tuple[np.ndarray, np.ndarray] | None:
+        with self.lock:
+            if not self.ready:
+                return None
+            feature_index, overrides = self.feature_index, dict(self._overrides)
+        changed = np.fromiter(overrides, dtype=np.int64, count=len(overrides))
+
+        rows, scores = None, None
+        for feature in features:
+            feature_rows, feature_values = feature_index.postings(feature)
+            if len(changed):
+                # overlay rows replace their base entries
+                keep = ~np.isin(feature_rows, changed)
+                overlay = [(row, values[np.searchsorted(indices, feature)])
+                           for row, (indices, values) in overrides.items()
+                           if feature in indices]
+                feature_rows = np.concatenate(
+                    (feature_rows[keep], np.array([r for r, _ in overlay], dtype=np.int64)))
+                feature_values = np.concatenate(
+                    (feature_values[keep], np.array([v for _, v in overlay], dtype=np.float32)))
+            if rows is None:
+                rows, scores = feature_rows, feature_values.astype(np.float32)
+            else:
+                rows, left, right = np.intersect1d(rows, feature_rows, return_indices=True)
+                scores = scores[left] + feature_values[right]
+            if len(rows) == 0:
+                break
+
+        if rows is None or len(rows) == 0:
+            return np.empty(0, dtype=np.int64), EMPTY_VALUES
+        top_k = min(top_k, len(rows))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return rows[best], scores[best]
+
+    # compacted CSR arrays, safe to write out while the matrix keeps changing
+    # outputs: indptr (np.ndarray), indices (np.ndarray), data (np.ndarray)
+    def snapshot(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with self.lock:
+            self.compact()
+            return self.indptr, self.indices, self.data
+
+    # write the matrix (or an earlier snapshot of it) with the fingerprint of
+    # the embeddings state it reflects and the stable id of every storage row
+    # inputs: path (str), fingerprint (list), ids (np.ndarray), snapshot (tuple or None)
+    def save(self, path: str, fingerprint: list, ids: np.ndarray, snapshot=None):
+        indptr, indices, data = snapshot or self.snapshot()
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, data=data, indices=indices, indptr=indptr,
+                 shape=np.array([len(indptr) - 1, self.n_features]), format=np.array('csr'),
+                 threshold=np.array(self.threshold), fingerprint=np.array(fingerprint),
+                 ids=np.asarray(ids, dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    # load a saved matrix if it was written for the given embeddings state;
+    # rows are storage rows, so the stable ids of the rows must match too
+    # (a compaction drops removed rows and renumbers the ones after them)
+    # inputs: path (str), n_features (int), threshold (float), fingerprint (list), ids (np.ndarray)
+    # outputs: matrix (ActivationMatrix) or None
+    @classmethod
+    def load(cls, path: str, n_features: int, threshold: float,
+             fingerprint: list, ids: np.ndarray) -> 'ActivationMatrix | None':
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if (f['shape'][1] != n_features or float(f['threshold']) != threshold
+                    or f['fingerprint'].tolist() != list(fingerprint)
+                    or 'ids' not in f or not np.array_equal(f['ids'], ids)):
+                return None
+            matrix = cls(n_features, threshold)
+            matrix.set_base(f['indptr'], f['indices'], f['data'])
+        return matrix
+
+    def nbytes(self) -> int:
+        with self.lock:
+            overlay = sum(i.nbytes + v.nbytes for i, v in self._overrides.values())
+            base = 0 if self.indptr is None else self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+            index = 0 if self.feature_index is None else self.feature_index.nbytes()
+            return base + index + overlay
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'ready': self.ready,
+                'rows': self.n_rows,
+                'nnz': len(self.data) + sum(len(i) for i, _ in self._overrides.values()),
+                'overlay_rows': len(self._overrides),
+                'lookups': self.lookups,
+                'nbytes': self.nbytes(),
+            }
@@ -0,0 +1,98 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Process-wide registry of immutable SAE artifacts.
+
+Several datasets share the same SAE model and feature dictionary (e.g. all
+wiki-based datasets), so each artifact set is loaded once per process and
+handed out as a read-only shared reference.
+"""
+
+import threading
+
+import numpy as np
+import torch
+
+from utils.feature_neighbors import (build_feature_neighbor_table, features_source, load_feature_neighbor_table,
+                                     save_feature_neighbor_table)
+from utils.feature_store import FeatureStore, load_feature_store
+from utils.sae_inference import InferenceSAE
+from utils.sparse_autoencoder import SparseAutoencoder, load_sae_file
+
+
+class SharedArtifacts:
+    """SAE model, feature vectors, feature-neighbor table and feature metadata.
+
+    Must not be mutated: the same instance is used by every dataset that
+    maps to this SAE.
+    """
+
+    def __init__(self, name: str, sae: torch.nn.Module | InferenceSAE, features: np.ndarray,
+                 feature_neighbors: np.ndarray, feature_neighbor_scores: np.ndarray,
+                 feature_store: FeatureStore):
+        self.name = name
+        self.sae = sae
+        self.features = features
+        self.feature_neighbors = feature_neighbors
+        self.feature_neighbor_scores = feature_neighbor_scores
+        self.feature_store = feature_store
+
+
+_registry: dict[tuple[str, str, str | None], SharedArtifacts] = {}
+_registry_lock = threading.Lock()
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
+
+def _load_artifacts(name: str, model_folder: str, device: torch.device,
+                    precision: str | None = None) -> SharedArtifacts:
+    # Load the sae model
+    sae_path = model_folder + f'{name}_model.safetensors'
+    sae = SparseAutoencoder.from_safetensors_file(
+        sae_path) if name == 'wiki' else load_sae_file(sae_path)
+    sae.to(device)  # move the model to the device
+    sae.eval()
+    sae.requires_grad_(False)
+    if precision is not None:
+        # serve the reduced-precision export, the float32 weights are dropped
+        sae = InferenceSAE(sae, precision)
+    print(f'\nsae model loaded ({precision or "float32"})')
+
+    # Load the features
+    features = _read_only(np.load(model_folder + f'{name}_features.npy'))
+
+    # Load the precomputed feature-neighbor table, building it on first use
+    source = features_source(model_folder, name, len(features))
+    table = load_feature_neighbor_table(model_folder, name, source)
+    if table is None:
+        print('\nno feature neighbor table found, building it...')
+        save_feature_neighbor_table(
+            model_folder, name, *build_feature_neighbor_table(features), source)
+        table = load_feature_neighbor_table(model_folder, name, source)
+    feature_neighbors, feature_neighbor_scores = table
+    feature_store = load_feature_store(model_folder, name, len(features))
+    print('\nfeatures loaded')
+    print('features shape:', features.shape)
+    print('feature info:', len(feature_store.ids), 'features')
+    print('feature neighbors shape:', feature_neighbors.shape)
+
+    return SharedArtifacts(name, sae, features, feature_neighbors,
+                           feature_neighbor_scores, feature_store)
+
+
+# get the shared artifacts for the given SAE name, loading them on first use
+# inputs: name (str), model_folder (str), device (torch.device), precision (str or None for float32)
+# outputs: artifacts (SharedArtifacts)
+def get_shared_artifacts(name: str, model_folder: str, device: torch.device,
+                         precision: str | None = None) -> SharedArtifacts:
+    key = (name, str(device), precision)
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = _load_artifacts(name, model_folder, device, precision)
+        else:
+            print(f'\nreusing shared {name} sae artifacts')
+        return _registry[key]
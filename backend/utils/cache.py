@@ -0,0 +1,173 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Two-tier key-value cache: a bounded in-memory LRU in front of an optional
+SQLite file that survives restarts.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+class PersistentLRUCache:
+    """Bounded LRU cache with an optional on-disk SQLite tier.
+
+    Values are kept as Python objects in memory and as bytes on disk, using
+    the given serialize/deserialize functions. If `max_disk_bytes` is set,
+    the least recently used disk entries are deleted to stay under it.
+    Memory hits also count as uses: their `last_used` updates are batched
+    and written at most every `touch_interval` seconds, and before evicting.
+    """
+
+    touch_interval = 5.0
+
+    def __init__(self, name: str, max_items: int = 10000, path: str | None = None,
+                 serialize: Callable[[Any], bytes] | None = None,
+                 deserialize: Callable[[bytes], Any] | None = None,
+                 max_disk_bytes: int | None = None):
+        self.name = name
+        self.max_items = max_items
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self._memory: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        self._touched: dict[str, float] = {}
+        self._touch_flushed = time.time()
+
+        self._db = None
+        self._disk_bytes = 0
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, '
+                             'size INTEGER DEFAULT 0, last_used REAL DEFAULT 0)')
+            # caches created before size-based eviction only have key/value
+            columns = [row[1] for row in self._db.execute(
+                'PRAGMA table_info(cache)')]
+            if 'size' not in columns:
+                self._db.execute(
+                    'ALTER TABLE cache ADD COLUMN size INTEGER DEFAULT 0')
+                self._db.execute(
+                    'ALTER TABLE cache ADD COLUMN last_used REAL DEFAULT 0')
+                self._db.execute('UPDATE cache SET size = length(value)')
+            self._db.commit()
+            self._disk_bytes = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def _remember(self, key: str, value: Any):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self._touch(key)
+                return self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = self.deserialize(row[0])
+                    self._remember(key, value)
+                    self.disk_hits += 1
+                    if self.max_disk_bytes is not None:
+                        self._db.execute('UPDATE cache SET last_used = ? WHERE key = ?',
+                                         (time.time(), key))
+                        self._db.commit()
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        self.put_many([(key, value)])
+
+    # store several entries in one disk transaction, evicting once at the end
+    # inputs: items (list of (key, value))
+    def put_many(self, items: list[tuple[str, Any]]):
+        items = dict(items)  # the last value of a repeated key wins
+        if not items:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._remember(key, value)
+                self._touched.pop(key, None)
+            if self._db is not None:
+                keys = list(items)
+                old = {}
+                for start in range(0, len(keys), 500):  # stay under SQLite's variable limit
+                    chunk = keys[start:start + 500]
+                    old.update(self._db.execute(
+                        f'SELECT key, size FROM cache WHERE key IN ({",".join("?" * len(chunk))})',
+                        chunk).fetchall())
+                now = time.time()
+                rows = []
+                for key, value in items.items():
+                    data = self.serialize(value)
+                    rows.append((key, sqlite3.Binary(data), len(data), now))
+                self._db.executemany('INSERT OR REPLACE INTO cache (key, value, size, last_used) '
+                                     'VALUES (?, ?, ?, ?)', rows)
+                self._disk_bytes += sum(row[2] for row in rows) - sum(old.values())
+                self._evict_disk()
+                self._db.commit()
+
+    # record a use of a disk entry served from memory, for the disk LRU order
+    def _touch(self, key: str):
+        if self._db is None or self.max_disk_bytes is None:
+            return
+        now = time.time()
+        self._touched[key] = now
+        if now - self._touch_flushed >= self.touch_interval:
+            self._flush_touches()
+            self._db.commit()
+
+    def _flush_touches(self):
+        if self._touched:
+            self._db.executemany('UPDATE cache SET last_used = ? WHERE key = ?',
+                                 [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+        self._touch_flushed = time.time()
+
+    def _evict_disk(self):
+        if self.max_disk_bytes is None or self._disk_bytes <= self.max_disk_bytes:
+            return
+        self._flush_touches()
+        rows = self._db.execute(
+            'SELECT key, size FROM cache ORDER BY last_used ASC').fetchall()
+        for key, size in rows:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._disk_bytes -= size
+            self.disk_evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_items': len(self._memory),
+            'disk_bytes': self._disk_bytes,
+            'disk_evictions': self.disk_evictions,
+        }
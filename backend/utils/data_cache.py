@@ -0,0 +1,129 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+In-memory cache of serialized dataset payloads for /data/<dataset>.
+
+Each dataset is the dataset file with its sentence journal applied (see
+sentence_store.py). It is parsed once, and again only when either file
+changes on disk, and kept as precompressed JSON and as a binary columnar
+encoding.
+
+Columnar layout (little-endian, every section 4-byte aligned):
+
+    b'AMPC' | uint32 version | uint32 header length | header JSON | body
+
+The header lists `num_rows`, the `columns` ({name, type, offset, length})
+and the shared `strings` table ({offsets, data, count, length}); offsets
+are relative to the start of the body. float32 columns hold one value per
+row (NaN for missing values). string columns hold one uint32 index per row into the string table
+(0xFFFFFFFF for missing values). The string table is count + 1 uint32 byte
+offsets followed by the UTF-8 data.
+"""
+
+import gzip
+import hashlib
+import json
+import struct
+import threading
+
+import numpy as np
+
+from utils.sentence_store import SentenceStore
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip is used without it
+    brotli = None
+
+COLUMNAR_MAGIC = b'AMPC'
+COLUMNAR_VERSION = 1
+MISSING_STRING = 0xFFFFFFFF
+
+
+def _pad(data: bytes, fill: bytes = b'\0') -> bytes:
+    return data + fill * (-len(data) % 4)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# encode a list of row dicts in the binary columnar format described above
+# inputs: rows (list)
+# outputs: data (bytes)
+def encode_columnar(rows: list[dict]) -> bytes:
+    names = list(dict.fromkeys(key for row in rows for key in row))
+    strings: dict[str, int] = {}
+    sections, columns, offset = [], [], 0
+
+    for name in names:
+        values = [row.get(name) for row in rows]
+        if (all(v is None or _is_number(v) for v in values)
+                and any(v is not None for v in values)):
+            data = np.asarray([np.nan if v is None else v for v in values], dtype='<f4').tobytes()
+            column_type = 'float32'
+        else:
+            indices = [MISSING_STRING if v is None else strings.setdefault(str(v), len(strings))
+                       for v in values]
+            data = np.asarray(indices, dtype='<u4').tobytes()
+            column_type = 'string'
+        columns.append({'name': name, 'type': column_type,
+                        'offset': offset, 'length': len(data)})
+        sections.append(_pad(data))
+        offset += len(sections[-1])
+
+    encoded = [s.encode('utf-8') for s in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+    string_offsets[1:] = np.cumsum([len(s) for s in encoded])
+    string_data = b''.join(encoded)
+    table = {'count': len(encoded), 'offsets': offset,
+             'data': offset + string_offsets.nbytes, 'length': len(string_data)}
+    sections.append(string_offsets.tobytes())
+    sections.append(_pad(string_data))
+
+    # pad the header with spaces so it still parses as JSON
+    header = _pad(json.dumps({'num_rows': len(rows), 'columns': columns,
+                              'strings': table}).encode('utf-8'), b' ')
+    prefix = COLUMNAR_MAGIC + struct.pack('<II', COLUMNAR_VERSION, len(header))
+    return prefix + header + b''.join(sections)
+
+
+class DatasetPayload:
+    """Serialized variants of one dataset file.
+
+    `variants[format][encoding]` holds the bytes for format "json" or
+    "columnar" and encoding "identity", "gzip" or "br".
+    """
+
+    def __init__(self, rows: list[dict], source: list):
+        self.source = source
+        self.num_rows = len(rows)
+        self.variants = {}
+        self.etags = {}
+        for fmt, data in [('json', json.dumps(rows).encode('utf-8')),
+                          ('columnar', encode_columnar(rows))]:
+            variant = {'identity': data, 'gzip': gzip.compress(data, 6)}
+            if brotli is not None:
+                variant['br'] = brotli.compress(data)
+            self.variants[fmt] = variant
+            self.etags[fmt] = hashlib.sha1(data).hexdigest() + f'-{fmt}'
+
+
+class DataPayloadCache:
+    def __init__(self):
+        self._payloads: dict[str, DatasetPayload] = {}
+        self._lock = threading.Lock()
+
+    # get the payload for the live rows of a dataset, parsing it again only if it changed
+    # inputs: data_file (str), journal_file (str)
+    # outputs: payload (DatasetPayload)
+    def get(self, data_file: str, journal_file: str) -> DatasetPayload:
+        source = SentenceStore.fingerprint(data_file, journal_file)
+        with self._lock:
+            payload = self._payloads.get(data_file)
+            if payload is None or payload.source != source:
+                rows = SentenceStore(data_file, journal_file).load().live_rows()
+                payload = DatasetPayload(rows, source)
+                self._payloads[data_file] = payload
+            return payload
@@ -0,0 +1,164 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Lazily built, LRU-evicted per-dataset objects.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable
+
+
+class DatasetRegistry:
+    """Builds a dataset object the first time it is requested.
+
+    At most `max_resident` objects are kept, and their estimated total size
+    (from the object's `memory_footprint()`) is kept under `memory_budget`
+    bytes by evicting the least recently used ones. The most recently
+    requested dataset is never evicted. Evicted objects are closed (if they
+    have a `close()` method) before the same dataset can be built again, so
+    two instances never write the same files.
+
+    Requests that use an object take a lease on it (`lease()` or
+    `acquire()`/`release()`). An object evicted while leased stays open
+    until its last lease is released, and only then is it closed.
+    """
+
+    def __init__(self, factory: Callable[[str], Any], names: list[str],
+                 max_resident: int = 3, memory_budget: int | None = None):
+        self.factory = factory
+        self.names = list(names)
+        self.max_resident = max_resident
+        self.memory_budget = memory_budget
+        self._resident: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.names}
+        self._leases = {name: 0 for name in self.names}
+        # evicted objects not closed yet; a reload waits until they are
+        self._retired: dict[str, Any] = {}
+        self._closed = threading.Condition(self._lock)
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._load_locks
+
+    def __getitem__(self, name: str) -> Any:
+        return self.get(name)
+
+    # the object of a dataset, without a lease; it can be closed by a later eviction
+    def get(self, name: str) -> Any:
+        return self._get(name, lease=False)
+
+    # the object of a dataset, leased until the matching release()
+    def acquire(self, name: str) -> Any:
+        return self._get(name, lease=True)
+
+    def release(self, name: str):
+        with self._lock:
+            self._leases[name] -= 1
+            close = self._leases[name] == 0 and name in self._retired
+        if close:
+            self._close(name)
+
+    # lease the object of a dataset for the duration of a with block
+    @contextmanager
+    def lease(self, name: str):
+        instance = self.acquire(name)
+        try:
+            yield instance
+        finally:
+            self.release(name)
+
+    def _get(self, name: str, lease: bool) -> Any:
+        if name not in self:
+            raise KeyError(f'unknown dataset: {name}')
+
+        with self._lock:
+            if name in self._resident:
+                return self._hit(name, lease)
+
+        # build outside the registry lock, once per dataset
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._resident:
+                    return self._hit(name, lease)
+                # an evicted instance of this dataset must be closed first
+                while name in self._retired:
+                    self._closed.wait()
+            start_time = time.time()
+            instance = self.factory(name)
+            print(f'{name} loaded in:', time.time() - start_time)
+            with self._lock:
+                self._resident[name] = instance
+                self.loads += 1
+                if lease:
+                    self._leases[name] += 1
+                evicted = self._evict()
+        # close after releasing this dataset's load lock, so two loads evicting
+        # each other's datasets cannot deadlock; leased ones close on their last release
+        for evicted_name in evicted:
+            self._close(evicted_name)
+        return instance
+
+    # a resident object, marked as most recently used (called under the registry lock)
+    def _hit(self, name: str, lease: bool) -> Any:
+        self._resident.move_to_end(name)
+        if lease:
+            self._leases[name] += 1
+        return self._resident[name]
+
+    # the currently loaded objects, least recently used first
+    def resident(self) -> dict[str, Any]:
+        with self._lock:
+            return dict(self._resident)
+
+    def _memory_used(self) -> int:
+        return sum(instance.memory_footprint() for instance in self._resident.values())
+
+    def _over_budget(self) -> bool:
+        if len(self._resident) > self.max_resident:
+            return True
+        return self.memory_budget is not None and self._memory_used() > self.memory_budget
+
+    # evict the least recently used objects (called under the registry lock)
+    # outputs: names of the evicted objects that have no lease and can be closed now
+    def _evict(self) -> list[str]:
+        evicted = []
+        while len(self._resident) > 1 and self._over_budget():
+            name, instance = self._resident.popitem(last=False)
+            self._retired[name] = instance
+            if self._leases[name] == 0:
+                evicted.append(name)
+            self.evictions += 1
+            print(f'evicted dataset {name}')
+        return evicted
+
+    # close a retired object, then let a waiting reload of its dataset proceed
+    def _close(self, name: str):
+        with self._lock:
+            instance = self._retired[name]
+        try:
+            close = getattr(instance, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            with self._lock:
+                del self._retired[name]
+                self._closed.notify_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'resident': list(self._resident),
+                'memory_used': self._memory_used(),
+                'memory_budget': self.memory_budget,
+                'max_resident': self.max_resident,
+                'loads': self.loads,
+                'evictions': self.evictions,
+                'leases': {name: count for name, count in self._leases.items() if count},
+                'retired': list(self._retired),
+            }
@@ -0,0 +1,81 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Content-addressed cache of sentence embeddings.
+"""
+
+import hashlib
+import io
+import threading
+import unicodedata
+
+import numpy as np
+import torch
+
+from utils.cache import PersistentLRUCache
+
+
+# normalize a sentence before hashing (unicode form + whitespace)
+# inputs: sentence (str)
+# outputs: normalized sentence (str)
+def normalize_sentence(sentence: str) -> str:
+    return ' '.join(unicodedata.normalize('NFC', sentence).split())
+
+
+def _serialize(embedding: torch.Tensor) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, embedding.numpy(), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _deserialize(data: bytes) -> torch.Tensor:
+    return torch.from_numpy(np.load(io.BytesIO(data), allow_pickle=False))
+
+
+class EmbeddingCache:
+    """Embeddings keyed by hash(model name, normalized sentence).
+
+    Also tracks encoder time spent on misses, to estimate the time saved
+    by hits.
+    """
+
+    def __init__(self, model_name: str, max_items: int = 50000, path: str | None = None):
+        self.model_name = model_name
+        self.store = PersistentLRUCache('embeddings', max_items=max_items, path=path,
+                                        serialize=_serialize, deserialize=_deserialize)
+        self._lock = threading.Lock()
+        self.encoded_sentences = 0
+        self.encode_seconds = 0.0
+
+    def key(self, sentence: str) -> str:
+        text = self.model_name + '\n' + normalize_sentence(sentence)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    # look up cached embeddings (CPU tensors, do not modify in place)
+    # inputs: sentences (list)
+    # outputs: embeddings (list), a torch.Tensor or None for each sentence
+    def get_many(self, sentences: list[str]) -> list[torch.Tensor | None]:
+        return [self.store.get(self.key(sentence)) for sentence in sentences]
+
+    def put_many(self, sentences: list[str], embeddings: torch.Tensor):
+        self.store.put_many([(self.key(sentence), embedding.detach().cpu().clone())
+                             for sentence, embedding in zip(sentences, embeddings)])
+
+    def record_encode(self, num_sentences: int, seconds: float):
+        with self._lock:
+            self.encoded_sentences += num_sentences
+            self.encode_seconds += seconds
+
+    def stats(self) -> dict:
+        stats = self.store.stats()
+        hits = stats['memory_hits'] + stats['disk_hits']
+        per_sentence = self.encode_seconds / \
+            self.encoded_sentences if self.encoded_sentences else 0.0
+        stats.update({
+            'model': self.model_name,
+            'encoded_sentences': self.encoded_sentences,
+            'encode_seconds': self.encode_seconds,
+            'estimated_seconds_saved': hits * per_sentence,
+        })
+        return stats
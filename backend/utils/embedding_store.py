@@ -0,0 +1,344 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Durable per-dataset embedding store: a memory-mapped snapshot plus a
+write-ahead log (WAL) of every mutation since that snapshot.
+
+Every sentence has a stable id that never changes or gets reused. Storage
+rows are only ever appended while the store is open: a removed sentence
+becomes a tombstone, and its row stays in place until the next compaction.
+Callers address sentences by position, i.e. their index among the live
+sentences in id order. This is the numbering the frontend uses.
+
+Files, in the dataset folder:
+
+    {name}_embeddings.{generation}.npy      snapshot (plain .npy, loaded with mmap)
+    {name}_embedding_ids.{generation}.npy   stable id of each snapshot row
+    {name}_embeddings.wal                    WAL for that snapshot generation
+
+The WAL starts with b'EWAL' and the uint64 snapshot generation it applies to.
+Records follow, each a `<BIII` header (op, id, count, crc32 of payload) and a
+payload of `count` embedding rows. Records refer to stable ids, so they stay
+valid after compaction. A torn record at the end of the WAL (a crash
+mid-write) is dropped on replay.
+
+Compaction writes the live rows as snapshot generation g + 1, which drops the
+tombstones. It then atomically swaps in a WAL for g + 1 that holds only the
+records written meanwhile, so a crash at any point leaves a matching
+snapshot/WAL pair on disk.
+"""
+
+import glob
+import os
+import re
+import struct
+import threading
+import zlib
+from typing import Callable
+
+import numpy as np
+
+WAL_MAGIC = b'EWAL'
+WAL_HEADER = struct.Struct('<4sQ')
+RECORD_HEADER = struct.Struct('<BIII')
+OP_ADD, OP_REPLACE, OP_REMOVE = 1, 2, 3
+
+
+class EmbeddingStore:
+    """Snapshot + WAL persistence and stable ids for one dataset's embeddings.
+
+    The caller owns the in-memory matrix. Its rows match `ids` and `alive`
+    here. Every mutation is applied to it and recorded here while holding
+    `lock`, so compaction always sees a matrix that matches the WAL position
+    it records.
+    """
+
+    def __init__(self, folder: str, name: str, compact_bytes: int = 64 * 1024 * 1024):
+        self.folder = folder
+        self.name = name
+        self.compact_bytes = compact_bytes
+        self.wal_path = os.path.join(folder, f'{name}_embeddings.wal')
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.dtype = None
+        self.dim = 0
+        self.ids = np.empty(0, dtype=np.int64)  # stable id of each row, ascending
+        self.alive = np.empty(0, dtype=bool)  # False for tombstoned rows
+        self.live_rows = np.empty(0, dtype=np.int64)  # row of each position
+        self.next_id = 0
+        self.replayed = 0
+        self.compactions = 0
+        self._wal = None
+        self._compacting = False
+        self._compact_thread = None
+
+    def snapshot_path(self, generation: int) -> str:
+        return os.path.join(self.folder, f'{self.name}_embeddings.{generation}.npy')
+
+    def ids_path(self, generation: int) -> str:
+        return os.path.join(self.folder, f'{self.name}_embedding_ids.{generation}.npy')
+
+    def _snapshot_generations(self) -> list[int]:
+        pattern = re.compile(re.escape(f'{self.name}_embeddings.') + r'(\d+)\.npy$')
+        generations = []
+        for path in glob.glob(os.path.join(self.folder, f'{self.name}_embeddings.*.npy')):
+            match = pattern.search(os.path.basename(path))
+            if match:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    def _read_wal_generation(self) -> int | None:
+        if not os.path.exists(self.wal_path):
+            return None
+        with open(self.wal_path, 'rb') as f:
+            header = f.read(WAL_HEADER.size)
+        if len(header) < WAL_HEADER.size or header[:4] != WAL_MAGIC:
+            return None
+        return WAL_HEADER.unpack(header)[1]
+
+    # load the embeddings: map the snapshot copy-on-write and replay the WAL
+    # (on first use, the snapshot is created from bootstrap())
+    # inputs: bootstrap (callable returning the initial np.ndarray)
+    # outputs: embeddings (np.ndarray), writable, sharing unmodified pages with the page cache
+    def load(self, bootstrap: Callable[[], np.ndarray]) -> np.ndarray:
+        with self.lock:
+            generations = self._snapshot_generations()
+            wal_generation = self._read_wal_generation()
+            if wal_generation is not None and wal_generation in generations:
+                self.generation = wal_generation
+            elif generations:
+                # no usable WAL: start a fresh one on the newest snapshot
+                self.generation = generations[-1]
+                wal_generation = None
+            else:
+                self.generation = 0
+                wal_generation = None
+                embeddings = np.ascontiguousarray(bootstrap())
+                self._write_snapshot(embeddings, np.arange(len(embeddings), dtype=np.int64), 0)
+            self._remove_stale_snapshots()
+
+            embeddings = np.load(self.snapshot_path(self.generation), mmap_mode='c')
+            ids_path = self.ids_path(self.generation)
+            self.ids = (np.load(ids_path) if os.path.exists(ids_path)
+                        else np.arange(len(embeddings), dtype=np.int64))
+            self.alive = np.ones(len(embeddings), dtype=bool)
+            self.dtype = embeddings.dtype
+            self.dim = embeddings.shape[1]
+            self.next_id = int(self.ids[-1]) + 1 if len(self.ids) else 0
+            if wal_generation is None:
+                self._reset_wal(self.wal_path, self.generation, b'')
+            else:
+                embeddings = self._replay(embeddings)
+            self.live_rows = np.flatnonzero(self.alive)
+            self._wal = open(self.wal_path, 'ab')
+            return embeddings
+
+    def _replay(self, embeddings: np.ndarray) -> np.ndarray:
+        row_bytes = self.dim * self.dtype.itemsize
+        with open(self.wal_path, 'rb') as f:
+            data = f.read()
+        # appended rows are concatenated in one go, when a replace needs them or at the end
+        pending_rows, pending_ids, removed = [], [], []
+
+        def flush(embeddings):
+            if pending_rows:
+                embeddings = np.concatenate([embeddings] + pending_rows)
+                self.ids = np.concatenate([self.ids] + pending_ids)
+                pending_rows.clear()
+                pending_ids.clear()
+            return embeddings
+
+        position = WAL_HEADER.size
+        while position + RECORD_HEADER.size <= len(data):
+            op, sentence_id, count, crc = RECORD_HEADER.unpack_from(data, position)
+            start = position + RECORD_HEADER.size
+            payload = data[start:start + count * row_bytes]
+            if len(payload) < count * row_bytes or zlib.crc32(payload) != crc:
+                break
+            rows = np.frombuffer(payload, dtype=self.dtype).reshape(count, self.dim)
+            if op == OP_ADD:
+                pending_rows.append(rows)
+                pending_ids.append(np.arange(sentence_id, sentence_id + count, dtype=np.int64))
+                self.next_id = sentence_id + count
+            elif op == OP_REPLACE:
+                embeddings = flush(embeddings)
+                embeddings[np.searchsorted(self.ids, sentence_id)] = rows[0]
+            elif op == OP_REMOVE:
+                removed.append(sentence_id)
+            self.replayed += 1
+            position = start + count * row_bytes
+        embeddings = flush(embeddings)
+        self.alive = ~np.isin(self.ids, removed)
+        if position < len(data):
+            print(f'{self.name} embeddings WAL: dropping {len(data) - position} bytes of torn record')
+            with open(self.wal_path, 'r+b') as f:
+                f.truncate(position)
+        print(f'{self.name} embeddings WAL: replayed {self.replayed} records')
+        return embeddings
+
+    def _write_snapshot(self, embeddings: np.ndarray, ids: np.ndarray, generation: int):
+        # the ids go first: a snapshot file only counts once both exist
+        for path, array in [(self.ids_path(generation), ids),
+                            (self.snapshot_path(generation), embeddings)]:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def _reset_wal(path: str, generation: int, records: bytes):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(WAL_HEADER.pack(WAL_MAGIC, generation) + records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _remove_stale_snapshots(self):
+        for generation in self._snapshot_generations():
+            if generation != self.generation:
+                os.remove(self.snapshot_path(generation))
+                if os.path.exists(self.ids_path(generation)):
+                    os.remove(self.ids_path(generation))
+
+    # write (op, sentence id, rows or None) records to the WAL with a single fsync
+    def _append(self, records: list[tuple[int, int, np.ndarray | None]]):
+        data = []
+        for op, sentence_id, rows in records:
+            payload = b'' if rows is None else np.ascontiguousarray(rows, dtype=self.dtype).tobytes()
+            count = 0 if rows is None else len(rows)
+            data.append(RECORD_HEADER.pack(op, sentence_id, count, zlib.crc32(payload)) + payload)
+        with self.lock:
+            if self._wal is None:
+                raise RuntimeError(f'{self.name} embedding store is closed')
+            self._wal.write(b''.join(data))
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+
+    @property
+    def size(self) -> int:
+        return len(self.live_rows)
+
+    # storage row of the sentence at the given position
+    # inputs: position (int)
+    # outputs: row (int) or None if there is no such sentence
+    def row(self, position: int) -> int | None:
+        if 0 <= position < len(self.live_rows):
+            return int(self.live_rows[position])
+        return None
+
+    # positions of the given live storage rows
+    # inputs: rows (np.ndarray)
+    # outputs: positions (np.ndarray)
+    def positions(self, rows: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.live_rows, rows)
+
+    # record appended embedding rows, which get the next stable ids
+    # inputs: rows (np.ndarray), kxm
+    def add(self, rows: np.ndarray):
+        rows = rows.reshape(-1, self.dim)
+        with self.lock:
+            self._append([(OP_ADD, self.next_id, rows)])
+            first_row = len(self.ids)
+            self.ids = np.concatenate(
+                (self.ids, np.arange(self.next_id, self.next_id + len(rows), dtype=np.int64)))
+            self.alive = np.concatenate((self.alive, np.ones(len(rows), dtype=bool)))
+            self.live_rows = np.concatenate(
+                (self.live_rows, np.arange(first_row, first_row + len(rows), dtype=np.int64)))
+            self.next_id += len(rows)
+
+    # record replaced embeddings, all in one WAL write
+    # inputs: positions (list), embs (np.ndarray), kxm
+    # outputs: rows (np.ndarray)
+    def replace(self, positions: list[int], embs: np.ndarray) -> np.ndarray:
+        embs = embs.reshape(-1, self.dim)
+        with self.lock:
+            rows = [self.row(position) for position in positions]
+            missing = [p for p, row in zip(positions, rows) if row is None]
+            if missing:
+                raise IndexError(f'no sentence at positions {missing}')
+            self._append([(OP_REPLACE, int(self.ids[row]), emb.reshape(1, self.dim))
+                          for row, emb in zip(rows, embs)])
+            return np.asarray(rows, dtype=np.int64)
+
+    # tombstone a sentence; later positions move up by one, storage rows stay put
+    # inputs: position (int)
+    # outputs: row (int), the tombstoned storage row
+    def remove(self, position: int) -> int:
+        with self.lock:
+            row = self.row(position)
+            if row is None:
+                raise IndexError(f'no sentence at position {position}')
+            self._append([(OP_REMOVE, int(self.ids[row]), None)])
+            self.alive[row] = False
+            self.live_rows = np.delete(self.live_rows, position)
+            return row
+
+    def wal_bytes(self) -> int:
+        return os.path.getsize(self.wal_path) if os.path.exists(self.wal_path) else 0
+
+    # identifies the current contents: changes with every logged mutation and compaction
+    # outputs: fingerprint (list)
+    def fingerprint(self) -> list:
+        with self.lock:
+            return [self.generation, self.wal_bytes()]
+
+    # start a background compaction once the WAL is larger than compact_bytes
+    # inputs: current (callable returning the current embeddings as np.ndarray)
+    def maybe_compact(self, current: Callable[[], np.ndarray]):
+        with self.lock:
+            if self._wal is None or self._compacting or self.wal_bytes() < self.compact_bytes:
+                return
+            self._compacting = True
+            # only live rows go into the snapshot
+            embeddings = np.array(current()[self.alive], dtype=self.dtype)
+            ids = self.ids[self.alive]
+            offset = self._wal.tell()
+            self._compact_thread = threading.Thread(
+                target=self._compact, args=(embeddings, ids, offset),
+                name=f'{self.name}-compact', daemon=True)
+            self._compact_thread.start()
+
+    # wait for a running compaction and close the WAL; later writes raise RuntimeError
+    def close(self):
+        thread = self._compact_thread
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
+    # write the embeddings as the next snapshot generation and restart the WAL
+    # from the records logged after `offset`
+    # inputs: embeddings (np.ndarray), ids (np.ndarray), offset (int)
+    def _compact(self, embeddings: np.ndarray, ids: np.ndarray, offset: int):
+        try:
+            generation = self.generation + 1
+            self._write_snapshot(embeddings, ids, generation)
+            with self.lock:
+                self._wal.close()
+                with open(self.wal_path, 'rb') as f:
+                    f.seek(offset)
+                    tail = f.read()
+                self._reset_wal(self.wal_path, generation, tail)
+                self._wal = open(self.wal_path, 'ab')
+                self.generation = generation
+                self.compactions += 1
+            self._remove_stale_snapshots()
+            print(f'{self.name} embeddings compacted to snapshot {generation}')
+        finally:
+            self._compacting = False
+
+    def stats(self) -> dict:
+        return {
+            'generation': self.generation,
+            'wal_bytes': self.wal_bytes(),
+            'sentences': self.size,
+            'tombstones': int(len(self.alive) - self.size),
+            'replayed_records': self.replayed,
+            'compactions': self.compactions,
+        }
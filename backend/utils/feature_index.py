@@ -0,0 +1,34 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Inverted index from SAE feature to the rows that activate it.
+
+Built from the CSR activation arrays: for every feature, the posting list
+holds the rows where it is active and their activations, sorted by
+descending activation (i.e. the CSC layout of the activation matrix with
+each column sorted by value).
+"""
+
+import numpy as np
+
+
+class FeatureIndex:
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, n_features: int):
+        entry_rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+        # group by feature, highest activation first within each feature
+        order = np.lexsort((-data, indices))
+        self.rows = entry_rows[order]
+        self.values = data[order]
+        self.feature_ptr = np.zeros(n_features + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=n_features), out=self.feature_ptr[1:])
+
+    # rows that activate the feature, sorted by descending activation
+    # inputs: feature (int)
+    # outputs: rows (np.ndarray), values (np.ndarray)
+    def postings(self, feature: int) -> tuple[np.ndarray, np.ndarray]:
+        start, end = self.feature_ptr[feature], self.feature_ptr[feature + 1]
+        return self.rows[start:end], self.values[start:end]
+
+    def nbytes(self) -> int:
+        return self.rows.nbytes + self.values.nbytes + self.feature_ptr.nbytes
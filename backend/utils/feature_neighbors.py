@@ -0,0 +1,120 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Precomputed feature-neighbor table.
+
+For every SAE feature we store the K most cosine-similar other features as
+an F x K int32 index array plus an F x K float16 score array (sorted by
+descending similarity). The table is built offline in row chunks, so the
+dense F x F similarity matrix is never materialized, and loaded with mmap.
+The row count, size and mtime of the features file it was built from are
+stored next to it, and a table built from another features file is
+treated as missing.
+
+Build from the backend folder with:
+
+    python -m utils.feature_neighbors wiki
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+
+# number of neighbors kept per feature for the given top percent
+# (one extra, since get_similar_features skips the closest neighbor)
+# inputs: n_features (int), top_percent (float)
+# outputs: k (int)
+def neighbor_count(n_features: int, top_percent: float) -> int:
+    return min(int((n_features - 1) * top_percent) + 1, n_features - 1)
+
+
+def build_feature_neighbor_table(features: np.ndarray, top_percent: float = 0.001,
+                                 chunk_size: int = 512) -> tuple[np.ndarray, np.ndarray]:
+    n_features = features.shape[0]
+    k = neighbor_count(n_features, top_percent)
+
+    normalized = np.asarray(features, dtype=np.float32)
+    norms = np.linalg.norm(normalized, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normalized = np.ascontiguousarray(normalized / norms)
+
+    indices = np.empty((n_features, k), dtype=np.int32)
+    scores = np.empty((n_features, k), dtype=np.float16)
+    for start in range(0, n_features, chunk_size):
+        end = min(start + chunk_size, n_features)
+        sims = normalized[start:end] @ normalized.T
+        # never list a feature as its own neighbor
+        sims[np.arange(end - start), np.arange(start, end)] = -np.inf
+        part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        part_sims = np.take_along_axis(sims, part, axis=1)
+        order = np.argsort(-part_sims, axis=1, kind='stable')
+        indices[start:end] = np.take_along_axis(part, order, axis=1)
+        scores[start:end] = np.take_along_axis(part_sims, order, axis=1)
+        print(f'feature neighbors: {end}/{n_features}', end='\r')
+    print()
+    return indices, scores
+
+
+def feature_neighbor_paths(model_folder: str, name: str) -> tuple[str, str, str]:
+    prefix = os.path.join(model_folder, f'{name}_feature_neighbors')
+    return prefix + '_indices.npy', prefix + '_scores.npy', prefix + '_source.npy'
+
+
+# identifies the features file a table is built from
+# inputs: model_folder (str), name (str), n_features (int)
+# outputs: source (list)
+def features_source(model_folder: str, name: str, n_features: int) -> list:
+    stat = os.stat(os.path.join(model_folder, f'{name}_features.npy'))
+    return [n_features, stat.st_size, stat.st_mtime_ns]
+
+
+def save_feature_neighbor_table(model_folder: str, name: str,
+                                indices: np.ndarray, scores: np.ndarray, source: list):
+    indices_path, scores_path, source_path = feature_neighbor_paths(model_folder, name)
+    np.save(indices_path, indices)
+    np.save(scores_path, scores)
+    np.save(source_path, np.array(source, dtype=np.int64))
+    print('feature neighbor table saved:', indices_path, scores_path)
+
+
+# load the feature neighbor table (memory-mapped), or None if it was not built
+# from the features file identified by source
+# inputs: model_folder (str), name (str), source (list)
+# outputs: (indices, scores) or None
+def load_feature_neighbor_table(model_folder: str, name: str,
+                                source: list) -> tuple[np.ndarray, np.ndarray] | None:
+    indices_path, scores_path, source_path = feature_neighbor_paths(model_folder, name)
+    if not all(os.path.exists(path) for path in [indices_path, scores_path, source_path]):
+        return None
+    if np.load(source_path).tolist() != list(source):
+        print('feature neighbor table is stale:', indices_path)
+        return None
+    indices, scores = np.load(indices_path, mmap_mode='r'), np.load(scores_path, mmap_mode='r')
+    if len(indices) != source[0] or len(scores) != source[0]:
+        return None
+    return indices, scores
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the feature-neighbor table for an SAE feature dictionary.')
+    parser.add_argument('name', help='SAE name, e.g. wiki')
+    parser.add_argument('--model-folder', default='../models/')
+    parser.add_argument('--top-percent', type=float, default=0.001)
+    parser.add_argument('--chunk-size', type=int, default=512)
+    args = parser.parse_args()
+
+    features = np.load(os.path.join(
+        args.model_folder, f'{args.name}_features.npy'), mmap_mode='r')
+    print('features shape:', features.shape)
+    indices, scores = build_feature_neighbor_table(
+        features, args.top_percent, args.chunk_size)
+    save_feature_neighbor_table(args.model_folder, args.name, indices, scores,
+                                features_source(args.model_folder, args.name, len(features)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Columnar feature metadata, indexed by feature id.
+
+Replaces the feature_info DataFrame: numeric columns (x, y) are numpy
+arrays with one entry per feature id, and text columns (summary, sample,
+sample_text) are int32 codes into one interned string table, stored as a
+UTF-8 blob plus offsets. Features without a row in the CSV have code -1
+and NaN coordinates.
+
+The parsed store is cached next to the CSV as `{name}_feature_info.npz`
+and rebuilt whenever the CSV changes, so startup does not re-parse it.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+TEXT_COLUMNS = ['summary', 'sample', 'sample_text']
+NUMERIC_COLUMNS = ['x', 'y']
+MISSING = -1
+
+
+# intern strings into one table
+# inputs: columns (dict of column name -> list of str or None)
+# outputs: blob (np.ndarray, uint8), offsets (np.ndarray), codes (dict of column name -> np.ndarray)
+def intern_strings(columns: dict[str, list]) -> tuple[np.ndarray, np.ndarray, dict[str, np.ndarray]]:
+    table: dict[str, int] = {}
+    codes = {}
+    for name, values in columns.items():
+        codes[name] = np.array(
+            [table.setdefault(v, len(table)) if isinstance(v, str) else MISSING for v in values],
+            dtype=np.int32)
+    encoded = [s.encode('utf-8') for s in table]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets, codes
+
+
+class FeatureStore:
+    """Feature metadata with O(1) lookup by id and vectorized gathers."""
+
+    def __init__(self, n_features: int, blob: np.ndarray, offsets: np.ndarray,
+                 codes: dict[str, np.ndarray], numeric: dict[str, np.ndarray]):
+        self.n_features = n_features
+        self._blob = blob.tobytes()
+        self._offsets = offsets
+        self.codes = codes
+        self.numeric = numeric
+
+    def __len__(self) -> int:
+        return self.n_features
+
+    # ids of the features that have metadata
+    @property
+    def ids(self) -> np.ndarray:
+        return np.flatnonzero(self.codes['summary'] != MISSING)
+
+    def _string(self, code: int) -> str | None:
+        if code == MISSING:
+            return None
+        return self._blob[self._offsets[code]:self._offsets[code + 1]].decode('utf-8')
+
+    # text of one feature
+    # inputs: feature (int), column (str)
+    # outputs: text (str) or None if the feature has no metadata
+    def text(self, feature: int, column: str = 'summary') -> str | None:
+        return self._string(int(self.codes[column][feature]))
+
+    # texts of several features, in order
+    # inputs: features (np.ndarray), column (str)
+    # outputs: texts (list of str or None)
+    def texts(self, features, column: str = 'summary') -> list[str | None]:
+        return [self._string(code) for code in self.codes[column][features].tolist()]
+
+    def summary(self, feature: int) -> str | None:
+        return self.text(feature, 'summary')
+
+    def summaries(self, features) -> list[str | None]:
+        return self.texts(features, 'summary')
+
+    # numeric column values of several features
+    # inputs: features (np.ndarray), column (str)
+    # outputs: values (np.ndarray)
+    def gather(self, features, column: str) -> np.ndarray:
+        return self.numeric[column][features]
+
+    # all metadata of one feature, as the feature_info CSV row
+    # inputs: feature (int)
+    # outputs: row (dict) or None
+    def get(self, feature: int) -> dict | None:
+        if self.codes['summary'][feature] == MISSING:
+            return None
+        row = {'feature': int(feature)}
+        row.update({column: self.text(feature, column) for column in TEXT_COLUMNS})
+        row.update({column: float(self.numeric[column][feature]) for column in NUMERIC_COLUMNS})
+        return row
+
+    def nbytes(self) -> int:
+        return (len(self._blob) + self._offsets.nbytes
+                + sum(c.nbytes for c in self.codes.values())
+                + sum(v.nbytes for v in self.numeric.values()))
+
+    # build the store from a feature_info CSV
+    # inputs: path (str), n_features (int)
+    # outputs: store (FeatureStore)
+    @classmethod
+    def from_csv(cls, path: str, n_features: int) -> 'FeatureStore':
+        df = pd.read_csv(path)
+        ids = df['feature'].to_numpy()
+        if len(ids) and (ids.min() < 0 or ids.max() >= n_features):
+            raise ValueError(f'{path} has feature ids outside [0, {n_features})')
+
+        columns = {}
+        for column in TEXT_COLUMNS:
+            values = [None] * n_features
+            if column in df:
+                for feature, value in zip(ids.tolist(), df[column].tolist()):
+                    values[feature] = value
+            columns[column] = values
+        blob, offsets, codes = intern_strings(columns)
+
+        numeric = {}
+        for column in NUMERIC_COLUMNS:
+            numeric[column] = np.full(n_features, np.nan, dtype=np.float32)
+            if column in df:
+                numeric[column][ids] = df[column].to_numpy(dtype=np.float32)
+        return cls(n_features, blob, offsets, codes, numeric)
+
+    def save(self, path: str, source: list):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, blob=np.frombuffer(self._blob, dtype=np.uint8), offsets=self._offsets,
+                 source=np.array(source), n_features=np.array(self.n_features),
+                 **{f'code_{k}': v for k, v in self.codes.items()},
+                 **{f'numeric_{k}': v for k, v in self.numeric.items()})
+        os.replace(tmp_path, path)
+
+    # load a cached store if it was built from the given CSV state
+    # inputs: path (str), n_features (int), source (list)
+    # outputs: store (FeatureStore) or None
+    @classmethod
+    def load(cls, path: str, n_features: int, source: list) -> 'FeatureStore | None':
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if int(f['n_features']) != n_features or f['source'].tolist() != list(source):
+                return None
+            codes = {column: f[f'code_{column}'] for column in TEXT_COLUMNS}
+            numeric = {column: f[f'numeric_{column}'] for column in NUMERIC_COLUMNS}
+            return cls(n_features, f['blob'], f['offsets'], codes, numeric)
+
+
+# load the feature metadata of an SAE, from the binary cache when the CSV is unchanged
+# inputs: model_folder (str), name (str), n_features (int)
+# outputs: store (FeatureStore)
+def load_feature_store(model_folder: str, name: str, n_features: int) -> FeatureStore:
+    csv_path = os.path.join(model_folder, f'{name}_feature_info.csv')
+    cache_path = os.path.join(model_folder, f'{name}_feature_info.npz')
+    stat = os.stat(csv_path)
+    source = [stat.st_size, stat.st_mtime_ns]
+    store = FeatureStore.load(cache_path, n_features, source)
+    if store is None:
+        store = FeatureStore.from_csv(csv_path, n_features)
+        store.save(cache_path, source)
+        print('feature info cache saved:', cache_path)
+    return store
@@ -0,0 +1,71 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Cache of vec2text inversions keyed by quantized target embedding.
+"""
+
+import hashlib
+import threading
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from utils.cache import PersistentLRUCache
+
+
+class InversionCache:
+    """Inverted sentences keyed by hash(corrector, settings, quantized embedding).
+
+    Target embeddings are L2-normalized and rounded to `quantization_step`,
+    so re-running the same steering settings maps to the same key even with
+    tiny floating point differences. Hit rates are tracked per dataset.
+    """
+
+    def __init__(self, corrector_name: str, quantization_step: float = 1e-3,
+                 max_items: int = 10000, path: str | None = None):
+        self.corrector_name = corrector_name
+        self.quantization_step = quantization_step
+        self.store = PersistentLRUCache('inversions', max_items=max_items, path=path,
+                                        serialize=lambda s: s.encode('utf-8'),
+                                        deserialize=lambda b: bytes(b).decode('utf-8'))
+        self._lock = threading.Lock()
+        self._dataset_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def key(self, embedding: torch.Tensor, settings: dict) -> str:
+        emb = embedding.detach().cpu().to(torch.float32).numpy().reshape(-1)
+        norm = np.linalg.norm(emb)
+        if norm > 0:
+            emb = emb / norm
+        quantized = np.round(emb / self.quantization_step).astype(np.int16)
+        digest = hashlib.sha256()
+        digest.update(self.corrector_name.encode('utf-8'))
+        digest.update(repr(sorted(settings.items())).encode('utf-8'))
+        digest.update(quantized.tobytes())
+        return digest.hexdigest()
+
+    # look up the inversion of each embedding row
+    # inputs: embeddings (torch.Tensor), settings (dict), dataset (str)
+    # outputs: sentences (list), a str or None for each row
+    def get_many(self, embeddings: torch.Tensor, settings: dict, dataset: str) -> list[str | None]:
+        results = [self.store.get(self.key(emb, settings)) for emb in embeddings]
+        hits = sum(r is not None for r in results)
+        with self._lock:
+            self._dataset_stats[dataset]['hits'] += hits
+            self._dataset_stats[dataset]['misses'] += len(results) - hits
+        return results
+
+    def put_many(self, embeddings: torch.Tensor, settings: dict, sentences: list[str]):
+        self.store.put_many([(self.key(emb, settings), sentence)
+                             for emb, sentence in zip(embeddings, sentences)])
+
+    def stats(self) -> dict:
+        stats = self.store.stats()
+        with self._lock:
+            stats['datasets'] = {
+                dataset: dict(counts, hit_rate=counts['hits'] / (counts['hits'] + counts['misses'])
+                              if counts['hits'] + counts['misses'] else 0.0)
+                for dataset, counts in self._dataset_stats.items()
+            }
+        return stats
@@ -0,0 +1,124 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Cross-request micro-batching for vec2text inversion.
+"""
+
+import threading
+import time
+
+import torch
+import vec2text
+
+
+class _PendingInversion:
+    def __init__(self, embeddings: torch.Tensor, settings: dict):
+        self.embeddings = embeddings
+        self.settings = settings
+        self.settings_key = tuple(sorted(settings.items()))
+        self.enqueued_at = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InversionScheduler:
+    """Gathers embeddings from concurrent callers (across all datasets) and
+    inverts them through the shared corrector as one batch.
+
+    Requests wait at most `max_wait` seconds for others to join; a batch
+    holds at most `max_batch_size` rows and only requests with the same
+    inversion settings.
+    """
+
+    def __init__(self, corrector, max_batch_size: int = 16, max_wait: float = 0.02):
+        self.corrector = corrector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: list[_PendingInversion] = []
+        self._condition = threading.Condition()
+        self.batches = 0
+        self.requests = 0
+        self.rows = 0
+        self._worker = threading.Thread(
+            target=self._run, name='inversion-scheduler', daemon=True)
+        self._worker.start()
+
+    # invert a (k, d) batch of embeddings, blocking until the result is ready
+    # inputs: embeddings (torch.Tensor), settings (kwargs for vec2text.invert_embeddings)
+    # outputs: sentences (list), one per embedding row
+    def invert(self, embeddings: torch.Tensor, **settings) -> list[str]:
+        if embeddings.dim() == 1:
+            embeddings = embeddings.unsqueeze(0)
+        pending = _PendingInversion(embeddings.detach(), settings)
+        with self._condition:
+            self._pending.append(pending)
+            self._condition.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _rows(self, requests: list[_PendingInversion]) -> int:
+        return sum(len(p.embeddings) for p in requests)
+
+    def _take_batch(self) -> list[_PendingInversion]:
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            # wait for more requests with the same settings as the oldest one
+            oldest = self._pending[0]
+            deadline = oldest.enqueued_at + self.max_wait
+            while True:
+                same = [p for p in self._pending
+                        if p.settings_key == oldest.settings_key]
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._rows(same) >= self.max_batch_size:
+                    break
+                self._condition.wait(remaining)
+
+            batch, rows = [], 0
+            for p in same:
+                if batch and rows + len(p.embeddings) > self.max_batch_size:
+                    break
+                batch.append(p)
+                rows += len(p.embeddings)
+            self._pending = [p for p in self._pending if p not in batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                device = batch[0].embeddings.device
+                embeddings = torch.cat([p.embeddings.to(device) for p in batch])
+                start_time = time.time()
+                sentences = vec2text.invert_embeddings(
+                    embeddings, self.corrector, **batch[0].settings)
+                print(f'Inverted {len(embeddings)} embeddings from {len(batch)} requests in:',
+                      time.time() - start_time)
+                offset = 0
+                for p in batch:
+                    p.result = sentences[offset:offset + len(p.embeddings)]
+                    offset += len(p.embeddings)
+                self.batches += 1
+                self.requests += len(batch)
+                self.rows += len(embeddings)
+            except Exception as e:
+                for p in batch:
+                    p.error = e
+            finally:
+                for p in batch:
+                    p.done.set()
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'requests': self.requests,
+            'rows': self.rows,
+            'mean_batch_rows': self.rows / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'max_wait': self.max_wait,
+        }
@@ -0,0 +1,154 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Background jobs with progress polling and cooperative cancellation.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+JOB_STATUSES = ['queued', 'running', 'done', 'failed', 'cancelled']
+
+
+class JobCancelled(Exception):
+    """Raised by Job.check() once cancellation was requested."""
+
+
+class Job:
+    """One unit of background work.
+
+    The job function receives the job and reports progress through
+    `update(progress, stage)`. It calls `check()` at safe points, which
+    raises JobCancelled once `cancel()` was requested, so work that cannot
+    be interrupted (e.g. a UMAP fit) is abandoned at the next checkpoint.
+    """
+
+    def __init__(self, kind: str, meta: dict | None = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.meta = meta or {}
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+
+    def update(self, progress: float, stage: str):
+        self.check()
+        self.progress = progress
+        self.stage = stage
+
+    def check(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+
+    def cancel(self):
+        self._cancel.set()
+        if self.status == 'queued':
+            self.status = 'cancelled'
+
+    @property
+    def finished_running(self) -> bool:
+        return self.status in ['done', 'failed', 'cancelled']
+
+    def to_dict(self, include_result: bool = True) -> dict:
+        info = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'cancel_requested': self._cancel.is_set(),
+            'elapsed': (self.finished or time.time()) - (self.started or self.created),
+            **self.meta,
+        }
+        if self.error is not None:
+            info['error'] = self.error
+        if include_result and self.status == 'done':
+            info['result'] = self.result
+        return info
+
+
+class JobManager:
+    """Runs jobs in the background and keeps the most recent ones for polling.
+
+    Every queue (e.g. one per dataset) has its own pool of `max_workers`
+    threads, so a long job on one queue never delays jobs on another.
+    """
+
+    def __init__(self, max_workers: int = 1, max_jobs: int = 100):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    # queue fn(job) to run in the background
+    # inputs: kind (str), fn (callable taking the job, returning its result), meta (dict), queue (str)
+    # outputs: job (Job)
+    def submit(self, kind: str, fn: Callable[[Job], Any], meta: dict | None = None,
+               queue: str = 'default') -> Job:
+        job = Job(kind, meta)
+        with self._lock:
+            self._jobs[job.id] = job
+            # forget the oldest finished jobs
+            for old_id in [i for i, j in self._jobs.items() if j.finished_running]:
+                if len(self._jobs) <= self.max_jobs:
+                    break
+                del self._jobs[old_id]
+            if queue not in self._executors:
+                self._executors[queue] = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=f'job-{queue}')
+            executor = self._executors[queue]
+        executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job: Job, fn: Callable[[Job], Any]):
+        if job.status == 'cancelled':
+            return
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = fn(job)
+            job.status = 'done'
+            job.progress = 1.0
+            job.stage = 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+            job.stage = 'cancelled'
+        except Exception as e:
+            print(f'{job.kind} job {job.id} failed: {e}')
+            job.status = 'failed'
+            job.error = str(e)
+        job.finished = time.time()
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # the running or queued job of the given kind matching meta, if any
+    # inputs: kind (str), meta (dict)
+    # outputs: job (Job) or None
+    def active(self, kind: str, **meta) -> Job | None:
+        with self._lock:
+            for job in self._jobs.values():
+                if (job.kind == kind and not job.finished_running
+                        and all(job.meta.get(k) == v for k, v in meta.items())):
+                    return job
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {status: 0 for status in JOB_STATUSES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
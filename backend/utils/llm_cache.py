@@ -0,0 +1,77 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Content-addressed cache of LLM responses with a replay-only mode.
+"""
+
+import hashlib
+import json
+from typing import Callable
+
+from utils.cache import PersistentLRUCache
+
+LLM_CACHE_MODES = ['readwrite', 'replay', 'off']
+
+
+class LLMCacheMiss(KeyError):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+class LLMResponseCache:
+    """LLM responses keyed by hash(model, temperature, system prompt, user prompt).
+
+    Modes:
+        readwrite: serve hits from the cache, call the llm and record misses
+        replay: serve hits only and fail fast with LLMCacheMiss on a miss
+        off: always call the llm
+    """
+
+    def __init__(self, mode: str = 'readwrite', max_items: int = 10000,
+                 path: str | None = None, max_disk_bytes: int | None = None):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f'invalid LLM cache mode: {mode}')
+        self.mode = mode
+        self.store = PersistentLRUCache('llm_responses', max_items=max_items, path=path,
+                                        serialize=lambda s: s.encode('utf-8'),
+                                        deserialize=lambda b: bytes(b).decode('utf-8'),
+                                        max_disk_bytes=max_disk_bytes)
+
+    @property
+    def replay(self) -> bool:
+        return self.mode == 'replay'
+
+    @staticmethod
+    def key(model: str, temperature: float, system_prompt: str, user_prompt: str, **params) -> str:
+        text = json.dumps([model, temperature, system_prompt, user_prompt, params],
+                          sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    # return the cached response for the request, or call request() on a miss
+    # sampled requests (e.g. sentence variations) should differ on every call:
+    # readwrite mode records them for replay but always asks the llm
+    # inputs: request (callable returning the response text), model (str),
+    #         temperature (float), system_prompt (str), user_prompt (str),
+    #         sampled (bool), params (other settings, e.g. the chunk index)
+    # outputs: response (str)
+    def complete(self, request: Callable[[], str], model: str, temperature: float,
+                 system_prompt: str, user_prompt: str, sampled: bool = False, **params) -> str:
+        if self.mode == 'off':
+            return request()
+
+        key = self.key(model, temperature, system_prompt, user_prompt, **params)
+        response = None if sampled and not self.replay else self.store.get(key)
+        if response is not None:
+            return response
+        if self.replay:
+            raise LLMCacheMiss(
+                f'no recorded {model} response for: {user_prompt[:80]}')
+
+        response = request()
+        self.store.put(key, response)
+        return response
+
+    def stats(self) -> dict:
+        stats = self.store.stats()
+        stats['mode'] = self.mode
+        return stats
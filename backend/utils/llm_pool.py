@@ -0,0 +1,45 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Bounded-concurrency pool for LLM calls.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator
+
+
+class LLMPool:
+    """Runs blocking LLM calls concurrently on a fixed number of worker threads.
+
+    The LLM client itself is shared (it keeps its own HTTP connection pool),
+    so independent calls from any request overlap instead of queueing.
+    """
+
+    def __init__(self, max_concurrency: int = 8):
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix='llm')
+        self._lock = threading.Lock()
+        self.submitted = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            self.submitted += 1
+        return self._executor.submit(fn, *args, **kwargs)
+
+    # yield (index, result) for each future as soon as it completes
+    # inputs: futures (list)
+    # outputs: iterator of (int, result)
+    @staticmethod
+    def as_completed(futures: list[Future]) -> Iterator[tuple[int, object]]:
+        index = {future: i for i, future in enumerate(futures)}
+        for future in as_completed(futures):
+            yield index[future], future.result()
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'submitted': self.submitted,
+        }
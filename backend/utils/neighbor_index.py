@@ -0,0 +1,126 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Exact cosine nearest-neighbor search over sentence embeddings.
+"""
+
+import numpy as np
+
+
+class NeighborIndex:
+    """On-demand top-k cosine neighbors.
+
+    L2-normalized embeddings are kept in one contiguous float32 buffer with
+    spare capacity; queries are answered with a blocked matmul and
+    argpartition, so no N x N similarity matrix is ever materialized.
+    Removed rows are tombstoned (skipped by search) rather than shifted out,
+    so row numbers stay stable.
+    """
+
+    def __init__(self, embeddings: np.ndarray, block_size: int = 16384, growth: float = 1.5):
+        self.block_size = block_size
+        self.growth = growth
+        embeddings = self._normalize(embeddings)
+        self.size = embeddings.shape[0]
+        self.dim = embeddings.shape[1]
+        self._buffer = np.empty(
+            (self._next_capacity(self.size), self.dim), dtype=np.float32)
+        self._buffer[:self.size] = embeddings
+        self._alive = np.ones(self.capacity, dtype=bool)
+        self.tombstones = 0
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings.reshape(1, -1)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(embeddings / norms)
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.shape[0]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._buffer[:self.size]
+
+    @property
+    def live(self) -> int:
+        return self.size - self.tombstones
+
+    def nbytes(self) -> int:
+        return self._buffer.nbytes + self._alive.nbytes
+
+    def _next_capacity(self, required: int) -> int:
+        return max(required, int(required * self.growth), 16)
+
+    def _reserve(self, required: int):
+        if required <= self.capacity:
+            return
+        buffer = np.empty(
+            (self._next_capacity(required), self.dim), dtype=np.float32)
+        buffer[:self.size] = self.vectors
+        self._buffer = buffer
+        alive = np.ones(self.capacity, dtype=bool)
+        alive[:self.size] = self._alive[:self.size]
+        self._alive = alive
+
+    def add(self, embeddings: np.ndarray):
+        """Append one (d,) or many (k, d) embeddings."""
+        embeddings = self._normalize(embeddings)
+        k = embeddings.shape[0]
+        self._reserve(self.size + k)
+        self._buffer[self.size:self.size + k] = embeddings
+        self.size += k
+
+    def replace(self, rows, embeddings: np.ndarray):
+        """Overwrite one row or an array of rows in place."""
+        self._buffer[np.atleast_1d(rows)] = self._normalize(embeddings)
+
+    def remove(self, rows):
+        """Tombstone one row or an array of rows; other rows keep their numbers."""
+        rows = np.atleast_1d(rows)
+        self.tombstones += int(self._alive[rows].sum())
+        self._alive[rows] = False
+
+    def search(self, queries: np.ndarray, top_k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k neighbors for a batch of query embeddings.
+
+        Returns (indices, scores), both (q, top_k) and sorted by descending
+        cosine similarity.
+        """
+        queries = self._normalize(queries)
+        top_k = min(top_k, self.live)
+        if top_k <= 0:
+            return (np.empty((queries.shape[0], 0), dtype=np.int64),
+                    np.empty((queries.shape[0], 0), dtype=np.float32))
+        best_idx = np.empty((queries.shape[0], 0), dtype=np.int64)
+        best_sim = np.empty((queries.shape[0], 0), dtype=np.float32)
+
+        for start in range(0, self.size, self.block_size):
+            end = min(start + self.block_size, self.size)
+            sims = queries @ self._buffer[start:end].T
+            if self.tombstones:
+                sims[:, ~self._alive[start:end]] = -np.inf
+            k = min(top_k, sims.shape[1])
+            part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            # merge the block candidates with the running best
+            cand_idx = np.concatenate((best_idx, part + start), axis=1)
+            cand_sim = np.concatenate(
+                (best_sim, np.take_along_axis(sims, part, axis=1)), axis=1)
+            if cand_idx.shape[1] > top_k:
+                keep = np.argpartition(-cand_sim, top_k - 1, axis=1)[:, :top_k]
+                cand_idx = np.take_along_axis(cand_idx, keep, axis=1)
+                cand_sim = np.take_along_axis(cand_sim, keep, axis=1)
+            best_idx, best_sim = cand_idx, cand_sim
+
+        order = np.argsort(-best_sim, axis=1, kind='stable')
+        return (np.take_along_axis(best_idx, order, axis=1),
+                np.take_along_axis(best_sim, order, axis=1))
+
+    def search_rows(self, rows: list[int], top_k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k neighbors for rows already in the index."""
+        return self.search(self.vectors[np.asarray(rows)], top_k)
@@ -0,0 +1,182 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Inference-only export of the sparse autoencoders for CPU serving.
+
+InferenceSAE holds the weights of a SparseAutoencoder or
+GatedSparseAutoencoder in reduced precision:
+
+- 'bf16': encoder and decoder weights in bfloat16, computed in bfloat16
+  and returned as float32.
+- 'int8': the encoder is a dynamically quantized linear layer (int8
+  weights with per-feature scales, run by torch's int8 CPU kernels); the
+  decoder rows are int8 with per-feature scales.
+
+Decoding only gathers the decoder rows of the active features
+(index_select) instead of a dense F x d matmul, and `encode_topk` returns
+only the k strongest features of each row.
+"""
+
+import time
+
+import torch
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+from torch.nn.functional import relu
+
+from utils.sparse_autoencoder import GatedSparseAutoencoder, SparseAutoencoder
+
+PRECISIONS = ['bf16', 'int8']
+
+
+class InferenceSAE(torch.nn.Module):
+    """Reduced-precision, inference-only SAE with the same encode/decode interface."""
+
+    def __init__(self, sae: SparseAutoencoder | GatedSparseAutoencoder, precision: str = 'int8'):
+        super().__init__()
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision must be one of {PRECISIONS}')
+        if precision == 'int8' and sae.W_enc.device.type != 'cpu':
+            raise ValueError('int8 SAE inference is only supported on cpu')
+
+        self.precision = precision
+        self.n_inputs = sae.n_inputs
+        self.n_features = sae.n_features
+        self.gated = isinstance(sae, GatedSparseAutoencoder)
+
+        with torch.no_grad():
+            # biases and gate parameters are small, keep them in float32
+            self.register_buffer('b_enc', sae.b_enc.detach().clone())
+            self.register_buffer('b_dec', sae.b_dec.detach().clone())
+            if self.gated:
+                self.register_buffer('b_gate', sae.b_gate.detach().clone())
+                self.register_buffer('gate_scale', torch.exp(sae.r_gate.detach()))
+
+            # x @ W_enc without bias, so the gated SAE can reuse it for the gate
+            W_enc = sae.W_enc.detach()
+            if precision == 'int8':
+                linear = torch.nn.Linear(self.n_inputs, self.n_features, bias=False)
+                linear.weight.copy_(W_enc.T)
+                self.encoder = quantize_dynamic(
+                    torch.nn.Sequential(linear), {torch.nn.Linear: per_channel_dynamic_qconfig},
+                    dtype=torch.qint8)
+                W_dec = sae.W_dec.detach()
+                dec_scale = W_dec.abs().amax(dim=1).clamp(min=1e-12) / 127.0
+                self.register_buffer('W_dec', torch.round(
+                    W_dec / dec_scale.unsqueeze(1)).to(torch.int8))
+                self.register_buffer('dec_scale', dec_scale)
+            else:
+                self.register_buffer('W_enc', W_enc.to(torch.bfloat16).contiguous())
+                self.register_buffer('W_dec', sae.W_dec.detach().to(torch.bfloat16).contiguous())
+                self.register_buffer('dec_scale', None)
+        self.requires_grad_(False)
+        self.eval()
+
+    def _pre_activations(self, x: torch.Tensor) -> torch.Tensor:
+        if self.gated:
+            x = x - self.b_dec
+        if self.precision == 'int8':
+            return self.encoder(x.to(torch.float32))
+        return torch.matmul(x.to(torch.bfloat16), self.W_enc).to(torch.float32)
+
+    @torch.no_grad()
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        x_W_enc = self._pre_activations(x)
+        mag = relu(x_W_enc + self.b_enc)
+        if not self.gated:
+            return mag
+        gate = x_W_enc * self.gate_scale.unsqueeze(0) + self.b_gate
+        return mag * (gate > 0)
+
+    # encode and keep only the k strongest features of each row
+    # inputs: x (torch.Tensor), bxm, k (int)
+    # outputs: values (torch.Tensor), bxk, indices (torch.Tensor), bxk, by descending activation
+    @torch.no_grad()
+    def encode_topk(self, x: torch.Tensor, k: int) -> tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, self.n_features)
+        if self.gated:
+            # the gate is not monotonic in the pre-activation, select on the activations
+            return torch.topk(self.encode(x), k, dim=1)
+        # relu is monotonic: select on the pre-activations, apply relu to the k winners only
+        values, indices = torch.topk(self._pre_activations(x) + self.b_enc, k, dim=1)
+        return relu(values), indices
+
+    # decoder rows of the given features, in float32
+    # inputs: features (torch.Tensor), n
+    # outputs: rows (torch.Tensor), nxm
+    def decoder_rows(self, features: torch.Tensor) -> torch.Tensor:
+        rows = self.W_dec.index_select(0, features).to(torch.float32)
+        if self.dec_scale is not None:
+            rows = rows * self.dec_scale.index_select(0, features).unsqueeze(1)
+        return rows
+
+    # decode sparse activations, touching only the active features
+    # inputs: values (torch.Tensor), bxk, indices (torch.Tensor), bxk
+    # outputs: reconstruction (torch.Tensor), bxm
+    @torch.no_grad()
+    def decode_sparse(self, values: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+        rows = self.decoder_rows(indices.reshape(-1)).view(*indices.shape, self.n_inputs)
+        return (values.to(torch.float32).unsqueeze(-1) * rows).sum(dim=1) + self.b_dec
+
+    # decode dense activations through their nonzero entries
+    # inputs: f (torch.Tensor), bxF
+    # outputs: reconstruction (torch.Tensor), bxm
+    @torch.no_grad()
+    def decode(self, f: torch.Tensor) -> torch.Tensor:
+        f = torch.atleast_2d(f)
+        batch, features = f.nonzero(as_tuple=True)
+        contributions = self.decoder_rows(features) * f[batch, features].to(torch.float32).unsqueeze(1)
+        out = self.b_dec.expand(f.shape[0], -1).clone()
+        return out.index_add_(0, batch, contributions)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.decode(self.encode(x))
+
+    def nbytes(self) -> int:
+        if self.precision == 'int8':
+            # packed int8 weights plus float32 per-feature scales
+            encoder = self.n_inputs * self.n_features + 4 * self.n_features
+        else:
+            encoder = self.W_enc.nbytes
+        return encoder + sum(b.nbytes for name, b in self.named_buffers() if name != 'W_enc')
+
+
+# compare a reduced-precision SAE against the float32 model
+# inputs: sae (SparseAutoencoder or GatedSparseAutoencoder), inference_sae (InferenceSAE),
+#         x (torch.Tensor), bxm, top_k (int), repeats (int)
+# outputs: report (dict) with parity metrics, latencies (s) and weight sizes (bytes)
+@torch.no_grad()
+def compare_inference(sae, inference_sae: InferenceSAE, x: torch.Tensor,
+                      top_k: int = 32, repeats: int = 10) -> dict:
+    def timed(fn):
+        fn()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            result = fn()
+        return result, (time.perf_counter() - start) / repeats
+
+    reference, reference_encode = timed(lambda: sae.encode(x))
+    activations, encode = timed(lambda: inference_sae.encode(x))
+    (values, indices), encode_topk = timed(lambda: inference_sae.encode_topk(x, top_k))
+    reference_decoded, reference_decode = timed(lambda: sae.decode(reference))
+    decoded, decode = timed(lambda: inference_sae.decode(activations))
+    _, decode_topk = timed(lambda: inference_sae.decode_sparse(values, indices))
+
+    reference_top = torch.topk(reference, top_k, dim=1).indices
+    overlap = sum(len(set(a.tolist()) & set(b.tolist()))
+                  for a, b in zip(reference_top, indices)) / reference_top.numel()
+    return {
+        'precision': inference_sae.precision,
+        'activation_max_abs_error': float((activations - reference).abs().max()),
+        'activation_cosine': float(torch.nn.functional.cosine_similarity(
+            activations, reference, dim=1).mean()),
+        'top_k_overlap': overlap,
+        'reconstruction_cosine': float(torch.nn.functional.cosine_similarity(
+            decoded, reference_decoded, dim=1).mean()),
+        'encode_s': {'float32': reference_encode, inference_sae.precision: encode,
+                     f'{inference_sae.precision}_topk': encode_topk},
+        'decode_s': {'float32': reference_decode, inference_sae.precision: decode,
+                     f'{inference_sae.precision}_topk': decode_topk},
+        'weight_bytes': {'float32': sum(p.nbytes for p in sae.parameters()),
+                         inference_sae.precision: inference_sae.nbytes()},
+    }
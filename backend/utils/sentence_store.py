@@ -0,0 +1,162 @@
+"""
+For licensing see accompanying LICENSE file.
+Copyright (C) 2024 Apple Inc. All Rights Reserved.
+
+Durable sentence text and 2d coordinates of one dataset, by stable id.
+
+Row i of the dataset file `{name}_data.json` is the sentence with stable id
+i (see embedding_store.py). Every later change is appended to the journal
+`{name}_sentences.jsonl` next to the embeddings WAL, one JSON record per
+line, fsynced:
+
+    {"op": "set", "ids": [...], "rows": [{"sentence": ..., "umap_x": ..., ...}, ...]}
+    {"op": "remove", "ids": [...]}
+
+A "set" record updates the given fields of each row and adds the rows it
+does not know yet. A torn line at the end of the journal (a crash mid-write)
+is ignored, and dropped when the writer loads the store. The live dataset is
+the original rows with the journal applied, in stable id order, which is the
+order of the frontend's sentence ids.
+
+Once the journal is larger than `compact_bytes` it is rewritten as one
+record of every changed row plus one of the removed ids.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class SentenceStore:
+    """Live rows of a dataset file plus a journal of their changes."""
+
+    def __init__(self, data_file: str, journal_file: str, compact_bytes: int = 16 * 1024 * 1024):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.rows: dict[int, dict] = {}
+        self.base_size = 0
+        self.changed: set[int] = set()  # ids whose row differs from the dataset file
+        self.removed: set[int] = set()  # ids removed from the dataset file
+
+    # read the dataset file and replay the journal; the writer truncates a torn
+    # record so that its next record starts on a new line
+    # inputs: truncate (bool)
+    # outputs: self
+    def load(self, truncate: bool = False) -> 'SentenceStore':
+        with self.lock:
+            base = []
+            if os.path.exists(self.data_file):
+                with open(self.data_file, 'r') as f:
+                    base = json.load(f)
+            self.rows = dict(enumerate(base))
+            self.base_size = len(base)
+            if not os.path.exists(self.journal_file):
+                return self
+            with open(self.journal_file, 'rb') as f:
+                data = f.read()
+            position = 0
+            while True:
+                end = data.find(b'\n', position)
+                if end < 0:
+                    break
+                try:
+                    record = json.loads(data[position:end])
+                except ValueError:
+                    break
+                self._apply(record)
+                position = end + 1
+            if position < len(data) and truncate:
+                print(f'{self.journal_file}: dropping {len(data) - position} bytes of torn record')
+                with open(self.journal_file, 'r+b') as f:
+                    f.truncate(position)
+        return self
+
+    def _apply(self, record: dict):
+        if record['op'] == 'set':
+            for sentence_id, row in zip(record['ids'], record['rows']):
+                self.rows.setdefault(sentence_id, {}).update(row)
+                self.changed.add(sentence_id)
+                self.removed.discard(sentence_id)
+        elif record['op'] == 'remove':
+            for sentence_id in record['ids']:
+                self.rows.pop(sentence_id, None)
+                self.changed.discard(sentence_id)
+                if sentence_id < self.base_size:
+                    self.removed.add(sentence_id)
+
+    def _append(self, records: list[dict]):
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        with open(self.journal_file, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            self._apply(record)
+
+    # update the given fields of the rows with the given stable ids
+    # inputs: ids (list or np.ndarray), rows (list of dict)
+    def set(self, ids, rows: list[dict]):
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self._append([{'op': 'set', 'ids': [int(i) for i in ids], 'rows': rows}])
+            self._maybe_compact()
+
+    # remove the rows with the given stable ids
+    # inputs: ids (list or np.ndarray)
+    def remove(self, ids):
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self._append([{'op': 'remove', 'ids': [int(i) for i in ids]}])
+            self._maybe_compact()
+
+    # stable ids of the live rows, ascending
+    @property
+    def ids(self) -> np.ndarray:
+        with self.lock:
+            return np.array(sorted(self.rows), dtype=np.int64)
+
+    # the live rows, in stable id order
+    # outputs: rows (list of dict)
+    def live_rows(self) -> list[dict]:
+        with self.lock:
+            return [self.rows[sentence_id] for sentence_id in sorted(self.rows)]
+
+    def _maybe_compact(self):
+        if os.path.getsize(self.journal_file) < self.compact_bytes:
+            return
+        changed = sorted(self.changed)
+        records = [{'op': 'set', 'ids': changed, 'rows': [self.rows[i] for i in changed]},
+                   {'op': 'remove', 'ids': sorted(self.removed)}]
+        tmp_path = self.journal_file + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_file)
+
+    # identifies the on-disk state of a dataset file and its journal
+    # inputs: data_file (str), journal_file (str)
+    # outputs: fingerprint (list)
+    @staticmethod
+    def fingerprint(data_file: str, journal_file: str) -> list:
+        journal = [0, 0]
+        if os.path.exists(journal_file):
+            stat = os.stat(journal_file)
+            journal = [stat.st_size, stat.st_mtime_ns]
+        return [os.stat(data_file).st_mtime_ns] + journal
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'sentences': len(self.rows),
+                'changed': len(self.changed),
+                'removed': len(self.removed),
+                'journal_bytes': (os.path.getsize(self.journal_file)
+                                  if os.path.exists(self.journal_file) else 0),
+            }
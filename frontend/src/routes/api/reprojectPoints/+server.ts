@@ -7,10 +7,13 @@ import type { RequestHandler } from "@sveltejs/kit";
 import { api_url } from '../../utils/consts';
 import { normalizeVal } from "../../utils/helpers";
 
+const POLL_INTERVAL_MS = 1000;
+
 // POST /api/reprojectPoints
 // Reproject points in the dataset by creating a new UMAP embedding
+// (the backend fits it in a background job, which is polled until it finishes)
 export const POST: RequestHandler = async ({ request }) => {
-    const { dataset } = await request.json();
+    const { dataset, warm_start } = await request.json();
     console.log('Reprojecting points in:', dataset);
     try {
         const apiUrl = `${api_url}/reembed_sentences`;
@@ -19,9 +22,19 @@ export const POST: RequestHandler = async ({ request }) => {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ dataset }),
+            body: JSON.stringify({ dataset, warm_start: !!warm_start }),
         });
-        const data = await response.json();
+        let job = await response.json();
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise((resolve) => setTimeout(resolve, POLL_INTERVAL_MS));
+            const jobResponse = await fetch(`${api_url}/jobs/${job.job_id}`);
+            job = await jobResponse.json();
+            console.log(`UMAP refit: ${job.stage} (${Math.round(job.progress * 100)}%)`);
+        }
+        if (job.status !== 'done') {
+            throw new Error(`UMAP refit ${job.status}: ${job.error ?? ''}`);
+        }
+        const data = job.result;
 
         const x_points = data.map((d: any) => d.umap_x);
         const y_points = data.map((d: any) => d.umap_y);